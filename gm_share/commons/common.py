@@ -105,13 +105,22 @@ def is_hybrid(request):
     return False
 
 
+_version_45 = LooseVersion('4.5')
+_version_under_45 = {}
+
+
 def support_new_tags(request):
     """only client version greater than 4.5 will return true."""
-    version = request.GET.get('version', '').strip() or '4.4'
-    version_under_45 = LooseVersion(version) < LooseVersion('4.5')
+    if not is_hybrid(request):
+        return False
 
-    if is_hybrid(request) and not version_under_45:
-        return True
-
-    return False
+    version = request.GET.get('version', '').strip() or '4.4'
+    version_under_45 = _version_under_45.get(version)
+    if version_under_45 is None:
+        version_under_45 = LooseVersion(version) < _version_45
+        # a handful of client versions are live at a time, stop growing on junk input
+        if len(_version_under_45) < 1000:
+            _version_under_45[version] = version_under_45
+
+    return not version_under_45
 
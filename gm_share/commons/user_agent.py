@@ -0,0 +1,48 @@
+# coding=utf-8
+import re
+
+from gm_share.commons.enums import PLATFORM_TYPE
+from gm_share.libs.local_cache import LocalCache
+
+
+# one scan finds every token; the lookahead lets tokens overlap ("GengmeiPhone")
+# the same way the separate re.search calls did
+_ua_tokens = re.compile(r'(?=(gengmei|gmdoctor|iphone|ipad|android))', re.IGNORECASE)
+_app_version = re.compile(r'(?:gengmei|gmdoctor)[/ ]v?(\d+(?:\.\d+)*)', re.IGNORECASE)
+
+# real traffic has few distinct user agents, parse each of them once per process
+_classified = LocalCache(maxsize=2048)
+
+
+def _classify(user_agent):
+    tokens = set(t.lower() for t in _ua_tokens.findall(user_agent))
+
+    from_client = 'gengmei' in tokens or 'gmdoctor' in tokens
+    if 'iphone' in tokens or 'ipad' in tokens:
+        platform = PLATFORM_TYPE.IOS
+    elif 'android' in tokens:
+        platform = PLATFORM_TYPE.ANDROID
+    else:
+        platform = PLATFORM_TYPE.PC
+
+    app_version = None
+    if from_client:
+        m = _app_version.search(user_agent)
+        if m:
+            app_version = m.group(1)
+    return platform, from_client, app_version
+
+
+def classify_user_agent(user_agent):
+    """(platform, from_client, app_version) of a User-Agent header.
+
+    app_version is the version of our app found in its own user agent, None elsewhere.
+    """
+    if not user_agent:
+        return PLATFORM_TYPE.UNKNOWN, False, None
+
+    classified = _classified.get(user_agent)
+    if classified is None:
+        classified = _classify(user_agent)
+        _classified.set(user_agent, classified, float('inf'))
+    return classified
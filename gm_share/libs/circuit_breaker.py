@@ -0,0 +1,113 @@
+# coding=utf-8
+import os
+import threading
+import time
+from collections import deque
+
+
+class CircuitBreaker(object):
+    """fail fast on a dependency that keeps failing.
+
+    closed: calls go through, outcomes of the last `window` seconds are kept.
+    open: entered once at least `min_calls` calls were seen in the window and
+        `failure_rate` of them failed; calls are rejected for `cooldown` seconds.
+    half_open: after the cooldown one probe call goes through, its success
+        closes the circuit, its failure opens it again.
+
+    state is per process, stats() is meant for metrics.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=30, cooldown=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._outcomes = deque()
+        self._failures = 0
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probing = False
+        self.rejected = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._probing = False
+            self._pid = os.getpid()
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def _open(self, now):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probing = False
+
+    def allow(self):
+        """whether a call may go out now, a rejected call must not be made."""
+        self._check_pid()
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.time() - self._opened_at >= self.cooldown:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        self._check_pid()
+        with self._lock:
+            if self._state == self.OPEN:
+                # a call that started before the circuit opened
+                return
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                self._probing = False
+                self._outcomes.clear()
+                self._failures = 0
+            now = time.time()
+            self._trim(now)
+            self._outcomes.append((now, True))
+
+    def record_failure(self):
+        self._check_pid()
+        with self._lock:
+            now = time.time()
+            if self._state == self.OPEN:
+                return
+            if self._state == self.HALF_OPEN:
+                self._open(now)
+                return
+            self._trim(now)
+            self._outcomes.append((now, False))
+            self._failures += 1
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= calls * self.failure_rate:
+                self._open(now)
+
+    def stats(self):
+        self._check_pid()
+        with self._lock:
+            self._trim(time.time())
+            return {
+                'name': self.name,
+                'state': self._state,
+                'calls': len(self._outcomes),
+                'failures': self._failures,
+                'rejected': self.rejected,
+                'opened_at': self._opened_at,
+            }
@@ -0,0 +1,82 @@
+# coding=utf-8
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """in-process cache in front of redis, every entry carries its own expiry.
+
+    entries are dropped in a forked child, so a worker never serves what
+    its parent cached before the fork. with maxsize, the least recently used
+    entry is evicted once the cache is full.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # the lock may have been held by a thread that does not exist in the child
+            self._lock = threading.Lock()
+            self._data = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self._pid = os.getpid()
+
+    def get(self, key):
+        self._check_pid()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expired_at = entry
+                if time.time() < expired_at:
+                    self.hits += 1
+                    if self.maxsize:
+                        # mark as most recently used
+                        del self._data[key]
+                        self._data[key] = entry
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expired_at):
+        """cache value until the unix timestamp expired_at."""
+        self._check_pid()
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expired_at)
+            if self.maxsize and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def expired_at(self, key):
+        """unix timestamp the entry of key expires at, None if not cached."""
+        self._check_pid()
+        with self._lock:
+            entry = self._data.get(key)
+        return entry[1] if entry is not None else None
+
+    def delete(self, key):
+        self._check_pid()
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._check_pid()
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        self._check_pid()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
@@ -0,0 +1,181 @@
+# coding=utf-8
+import bisect
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from gm_share.libs.log import exception_logger
+
+
+# dotted path of the class every finished request is reported to, None turns reporting off
+metrics_sink_path = getattr(settings, 'VIEW_METRICS_SINK', 'gm_share.libs.metrics.MemorySink')
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    """wall time of every stage and backend calls made by one request."""
+
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.started_at = time.time()
+        self.elapsed = None
+        # [(stage, seconds)] in the order the stages ran
+        self.stages = []
+        self.counts = {'rpc': 0, 'redis': 0, 'wechat': 0}
+        # calls made on pool threads count too, see bind
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def incr(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def server_timing(self):
+        """value of a Server-Timing header, durations in milliseconds."""
+        metrics = ['%s;dur=%.1f' % (stage, seconds * 1000) for stage, seconds in self.stages]
+        if self.elapsed is not None:
+            metrics.append('total;dur=%.1f' % (self.elapsed * 1000))
+        metrics.extend('%s;desc="%d"' % item for item in sorted(self.counts.items()))
+        return ', '.join(metrics)
+
+
+def start(view_name):
+    """begin timing the request handled by this thread."""
+    timings = _local.timings = RequestTimings(view_name)
+    return timings
+
+
+def finish(timings):
+    """stop timing and report to the sink, a failing sink never fails the request."""
+    timings.elapsed = time.time() - timings.started_at
+    _local.timings = None
+    sink = get_sink()
+    if sink is None:
+        return
+    try:
+        sink.record(timings)
+    except Exception as e:
+        exception_logger.error(e)
+
+
+def current():
+    """RequestTimings of the request handled by this thread, None outside of one."""
+    return getattr(_local, 'timings', None)
+
+
+def incr(name):
+    timings = current()
+    if timings is not None:
+        timings.incr(name)
+
+
+def bind(func):
+    """func counting its calls to the request of the calling thread, for pool threads."""
+    timings = current()
+    if timings is None:
+        return func
+
+    def bound(*args, **kwargs):
+        previous = current()
+        _local.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings = previous
+    return bound
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    global _sink
+    if _sink is None and metrics_sink_path:
+        with _sink_lock:
+            if _sink is None:
+                _sink = import_string(metrics_sink_path)()
+    return _sink
+
+
+# 0.1ms up to ~10 minutes, each bucket 25% wider than the one before
+_bucket_bounds = [0.0001 * 1.25 ** i for i in range(70)]
+
+
+class Histogram(object):
+    """latencies in log scaled buckets, percentiles are within 25% of the real value."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(_bucket_bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(_bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """upper bound of the bucket holding the p-th percentile, in seconds."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(_bucket_bounds[i], self.max) if i < len(_bucket_bounds) else self.max
+        return self.max
+
+
+class MemorySink(object):
+    """per view, per stage latency histograms in worker memory.
+
+    snapshot() is what a metrics endpoint or a periodic log line would show;
+    a sink shipping to statsd or prometheus only needs record(timings).
+    """
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._calls = {}
+
+    def record(self, timings):
+        with self._lock:
+            for stage, seconds in timings.stages + [('total', timings.elapsed)]:
+                key = (timings.view_name, stage)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.add(seconds)
+            calls = self._calls.setdefault(timings.view_name, {})
+            for name, n in timings.counts.items():
+                calls[name] = calls.get(name, 0) + n
+
+    def snapshot(self):
+        """{view: {stage: {count, mean, p50, p90, p99}, 'calls': {rpc, redis, wechat}}}, seconds."""
+        with self._lock:
+            views = {}
+            for (view_name, stage), histogram in self._histograms.items():
+                stats = {'count': histogram.count, 'mean': histogram.sum / histogram.count}
+                for p in self.percentiles:
+                    stats['p%d' % p] = histogram.percentile(p)
+                views.setdefault(view_name, {})[stage] = stats
+            for view_name, calls in self._calls.items():
+                views.setdefault(view_name, {})['calls'] = dict(calls)
+            return views
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._calls.clear()
@@ -0,0 +1,29 @@
+# coding=utf-8
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+_pools = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, size):
+    """named, bounded thread pool of this process.
+
+    worker threads do not survive fork, so a forked child gets fresh pools.
+    """
+    global _pools, _pools_pid, _pools_lock
+    if _pools_pid != os.getpid():
+        _pools = {}
+        _pools_lock = threading.Lock()
+        _pools_pid = os.getpid()
+
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = ThreadPool(size)
+    return pool
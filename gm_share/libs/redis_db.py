@@ -1,9 +1,37 @@
 from django.conf import settings
 import redis
+from redis.client import StrictPipeline
 
+from gm_share.libs import metrics
 
-db = redis.StrictRedis(
+
+class _CountingPipeline(StrictPipeline):
+    def execute(self, raise_on_error=True):
+        metrics.incr('redis')
+        return super(_CountingPipeline, self).execute(raise_on_error)
+
+
+class _CountingRedis(redis.StrictRedis):
+    """counts round trips of the current request, a pipeline is one."""
+
+    def execute_command(self, *args, **options):
+        metrics.incr('redis')
+        return super(_CountingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return _CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+db = _CountingRedis(
     host=settings.REDIS_CONFIG['host'],
     port=settings.REDIS_CONFIG['port'],
     db=settings.REDIS_CONFIG['db']
 )
+
+# only delete the lock if we still own it
+release_lock_script = db.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
@@ -1,9 +1,129 @@
+import json
+import sys
+import threading
+
 import helios.rpc
+import six
 
+from gm_share.libs import metrics
+from gm_share.libs.pool import get_pool
 from gm_share.settings import settings
 
 _RPC_INVOKER = helios.rpc.create_default_invoker(debug=settings.DEBUG).with_config(dump_curl=True)
 
+# threads per process sending the rpc calls queued by BatchingInvoker
+rpc_batch_pool_size = getattr(settings, 'RPC_BATCH_POOL_SIZE', 16)
+
 
 def get_base_rpc_invoker():
     return _RPC_INVOKER
+
+
+class CountingInvoker(object):
+    """helios invoker counting its calls to the request in gm_share.libs.metrics."""
+
+    def __init__(self, invoker):
+        self._invoker = invoker
+
+    def __getitem__(self, method):
+        func = self._invoker[method]
+
+        def call(*args, **kwargs):
+            metrics.incr('rpc')
+            return func(*args, **kwargs)
+        return call
+
+    def __getattr__(self, item):
+        return getattr(self._invoker, item)
+
+
+class BatchedRPCResult(object):
+    """RPCResult of a queued call, the queue is sent on first use."""
+
+    def __init__(self, batch, call):
+        self._batch = batch
+        self._call = call
+
+    def unwrap(self):
+        self._batch.flush()
+        return self._call.unwrap()
+
+    def __getattr__(self, item):
+        self._batch.flush()
+        return getattr(self._call.result, item)
+
+
+class _Call(object):
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+        self.value = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def unwrap(self):
+        self.done.wait()
+        if self.exc_info is not None:
+            six.reraise(*self.exc_info)
+        return self.value
+
+
+class BatchingInvoker(object):
+    """DataLoader like front of a helios invoker.
+
+    ctx.rpc[method](**params) only queues the call; calls with the same
+    method and params share one round trip. The queue is sent when a
+    result is first used or flush() is called, each queued call is then
+    run concurrently unless send_batch is overridden to hit a batch endpoint.
+    """
+
+    def __init__(self, invoker):
+        self._invoker = invoker
+        self._lock = threading.Lock()
+        self._queue = []
+        self._calls = {}
+
+    def __getitem__(self, method):
+        def call(**params):
+            try:
+                key = (method, json.dumps(params, sort_keys=True))
+            except (TypeError, ValueError):
+                key = (method, repr(sorted(params.items())))
+            with self._lock:
+                queued = self._calls.get(key)
+                if queued is None:
+                    queued = self._calls[key] = _Call(method, params)
+                    self._queue.append(queued)
+            return BatchedRPCResult(self, queued)
+        return call
+
+    def __getattr__(self, item):
+        return getattr(self._invoker, item)
+
+    def flush(self):
+        with self._lock:
+            queue, self._queue = self._queue, []
+            self._calls = {}
+        if queue:
+            self.send_batch(queue)
+
+    def send_batch(self, calls):
+        """send calls and fill in their results, concurrently by default."""
+        if len(calls) == 1:
+            self._send(calls[0])
+            return
+        pool = get_pool('rpc_batch', rpc_batch_pool_size)
+        send = metrics.bind(self._send)
+        pending = [pool.apply_async(send, (c,)) for c in calls]
+        for p in pending:
+            p.wait()
+
+    def _send(self, call):
+        try:
+            call.result = self._invoker[call.method](**call.params)
+            call.value = call.result.unwrap()
+        except:
+            call.exc_info = sys.exc_info()
+        finally:
+            call.done.set()
@@ -0,0 +1,51 @@
+# coding=utf-8
+import hashlib
+import json
+import time
+
+from django.conf import settings
+
+from gm_share.libs.local_cache import LocalCache
+from gm_share.libs.redis_db import db
+
+
+# seconds a session_key -> user_id mapping is trusted without asking the backend
+session_user_cache_ttl = getattr(settings, 'SESSION_USER_CACHE_TTL', 60)
+# seconds a worker keeps the mapping in memory, also how long other workers
+# may still see a session after invalidate_user_id
+session_user_local_ttl = getattr(settings, 'SESSION_USER_LOCAL_CACHE_TTL', 10)
+
+session_user_cache = LocalCache(maxsize=getattr(settings, 'SESSION_USER_LOCAL_CACHE_SIZE', 10000))
+
+
+def _cache_key(session_key):
+    # keep raw session keys out of redis
+    return 'c:su:%s' % hashlib.sha1(session_key.encode('utf-8')).hexdigest()
+
+
+def get_user_id(session_key):
+    """cached user_id of session_key, None if unknown."""
+    key = _cache_key(session_key)
+    user_id = session_user_cache.get(key)
+    if user_id is not None:
+        return user_id
+
+    cached = db.get(key)
+    if cached is None:
+        return None
+    user_id = json.loads(cached)
+    session_user_cache.set(key, user_id, time.time() + session_user_local_ttl)
+    return user_id
+
+
+def set_user_id(session_key, user_id):
+    key = _cache_key(session_key)
+    db.setex(key, session_user_cache_ttl, json.dumps(user_id))
+    session_user_cache.set(key, user_id, time.time() + session_user_local_ttl)
+
+
+def invalidate_user_id(session_key):
+    """forget session_key, call it on logout."""
+    key = _cache_key(session_key)
+    db.delete(key)
+    session_user_cache.delete(key)
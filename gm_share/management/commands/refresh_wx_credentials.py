@@ -0,0 +1,15 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+
+from gm_share.weixin.refresher import CredentialRefresher
+
+
+class Command(BaseCommand):
+    help = 'keep weixin access_token and jsapi_ticket renewed ahead of their expiry'
+
+    def handle(self, *args, **options):
+        refresher = CredentialRefresher()
+        try:
+            refresher.run()
+        except KeyboardInterrupt:
+            refresher.stop()
@@ -1,12 +1,24 @@
 # coding=utf-8
 
+import hashlib
+import json
 import re
 from urllib import urlencode
 
+from django.utils.encoding import force_text
 from django.utils.html import strip_tags
 from django.conf import settings
+from redis import RedisError
 
 from gm_share.commons.common import Config
+from gm_share.libs.log import exception_logger
+from gm_share.libs.redis_db import db
+
+
+# seconds a finished share payload is kept in redis
+share_payload_cache_ttl = getattr(settings, 'SHARE_PAYLOAD_CACHE_TTL', 3600)
+# bump when ShareData builds different payloads from the same arguments
+share_payload_version = 1
 
 
 _link = re.compile(
@@ -33,21 +45,290 @@ gengmei_link = re.compile(
 )
 
 
-def strip_markdown_links(md_txt, keep_image=False):
-    """strip markdown link and image."""
-    striped = _link.sub('', md_txt)
+# the scanners below strip exactly what the patterns above match, in linear
+# time; re backtracks on the nested alternation of _link and _image_link.
+# given complete=False they see only the head of a text and return the part
+# of the result nothing after the head can change
+_spaces = re.compile(r'\s*')
+_url_stop = re.compile(r'[\s>)]')
+_title_end = re.compile(r'''['"]\s*\)''')
+# a target without spaces, the lazy url group can only stop at its first )
+_plain_target = re.compile(r'\s*<?[^\s>)]*>?\)')
+_brackets = re.compile(r'[\[\]^]')
+_close_paren = re.compile(r'\)')
+_newline = re.compile(r'\n')
+_iframe_close = re.compile(r'</iframe>')
+_gengmei_target = re.compile(r'\]\(gengmei://')
+
+# a link whose end depends on text not seen yet
+_unknown = object()
+# a link text _plain_link_body can not tell, _link_bodies has to
+_nested = object()
+
+
+class _Seeker(object):
+    """pattern.search(text, pos) remembering its last match.
+
+    asked with growing pos, every character is scanned once in total.
+    """
+
+    def __init__(self, pattern, text):
+        self.pattern = pattern
+        self.text = text
+        self._pos = None
+        self._match = None
+
+    def search(self, pos):
+        if self._pos is None or pos < self._pos or (self._match is not None and pos > self._match.start()):
+            self._pos = pos
+            self._match = self.pattern.search(self.text, pos)
+        return self._match
+
+    def find(self, pos):
+        m = self.search(pos)
+        return m.start() if m else -1
+
+
+def _partial_tail(text, token):
+    """where text ends with the beginning of token, len(text) if it does not."""
+    for i in range(max(0, len(text) - len(token) + 1), len(text)):
+        if token.startswith(text[i:]):
+            return i
+    return len(text)
+
+
+def _link_bodies(text, complete=True):
+    r"""{position of a bracket: position of the ]( the link text starting right after it ends at}.
+
+    the link text (?:\[[^^\]]*\]|[^\[\]]|\](?=[^\[]*\]))* takes one way at every
+    character: a [ jumps past the next ] unless a ^ comes first, a ] goes on
+    only if another ] follows before any [, anything else is one step. so the
+    places it may stop form a chain, and re settles on the last ]( in it that
+    a ) follows somewhere. None where there is no such ](, _unknown where
+    the answer lies past the end of an incomplete text.
+    """
+    end = len(text)
+    last_paren = text.rfind(')')
+    after = {}
+    best = None if complete else _unknown
+    next_open = next_close = next_caret = None
+    for m in reversed(list(_brackets.finditer(text))):
+        pos = m.start()
+        ch = m.group()
+        if ch == '^':
+            next_caret = pos
+            continue
+        after[pos] = best
+        if ch == '[':
+            if next_close is not None and (next_caret is None or next_caret > next_close):
+                best = after[next_close]
+            elif complete or next_close is not None or next_caret is not None:
+                best = None
+            else:
+                best = _unknown
+            next_open = pos
+        else:
+            if text[pos + 1:pos + 2] == '(' and last_paren >= pos + 2:
+                stop = pos
+            elif complete or (pos + 1 < end and text[pos + 1] != '('):
+                stop = None
+            else:
+                stop = _unknown
+            if next_close is not None and (next_open is None or next_close < next_open):
+                best = best if best is not None else stop
+            elif complete or next_open is not None:
+                best = stop
+            else:
+                best = _unknown
+            next_close = pos
+    return after
+
+
+def _plain_link_body(text, pos, last_paren, complete=True):
+    """_link_bodies(text, complete)[pos] for a link text without brackets, _nested for any other.
+
+    with no [ before the first ] the link text can only end there, unless
+    another ] follows before the next [. both are looked for only up to the
+    next [, so the link texts of a text are read once all together.
+    """
+    next_open = text.find('[', pos + 1)
+    limit = len(text) if next_open == -1 else next_open
+    close = text.find(']', pos + 1, limit)
+    if close == -1 or text.find(']', close + 1, limit) != -1:
+        return _nested
+    if not complete and next_open == -1:
+        return _nested
+    if text[close + 1:close + 2] == '(' and last_paren >= close + 2:
+        return close
+    if complete or (close + 1 < len(text) and text[close + 1] != '('):
+        return None
+    return _nested
+
+
+def _link_target_end(text, pos, title_end, complete=True):
+    r"""end of \s*<?([\s\S]*?)>?(?:\s+['"]([\s\S]*?)['"])?\s*\) matched at pos.
+
+    the caller made sure a ) follows, so the lazy url group stops at the
+    first position where an optional title or a plain ) completes the link.
+    None if a title might still end after an incomplete text.
+    """
+    m = _plain_target.match(text, pos)
+    if m:
+        return m.end()
+
+    start = _spaces.match(text, pos).end()
+    if text[start:start + 1] == '<':
+        start += 1
+    paren = text.find(')', start)
+    url_end = start
+    while url_end <= paren:
+        # only a space, > or ) can end the url
+        url_end = _url_stop.search(text, url_end).start()
+        tail = url_end + 1 if text[url_end] == '>' else url_end
+        space_end = _spaces.match(text, tail).end()
+        if space_end > tail and text[space_end:space_end + 1] in ('"', "'"):
+            m = title_end.search(space_end + 1)
+            if m:
+                return m.end()
+            if not complete:
+                return None
+        if text[space_end:space_end + 1] == ')':
+            return space_end + 1
+        # every position up to the end of these spaces fails the same way
+        url_end = space_end if space_end > tail else url_end + 1
+    return paren + 1
+
+
+def _strip_links(text, image, complete=True):
+    """_link.sub('', text), or _image_link.sub('', text) with image."""
+    if complete and ('](' not in text or (image and '![' not in text)):
+        return text
+
+    # most link texts are plain, the chain of all brackets is built for the first that is not
+    bodies = None
+    last_paren = text.rfind(')')
+    title_end = _Seeker(_title_end, text)
+    parts = []
+    copied = 0
+    certain = _partial_tail(text, '![') if image and not complete else len(text)
+    # an image starts at !, a link at a [ without one
+    token = '![' if image else '['
+    start = text.find(token)
+    while start != -1:
+        pos = start + 1 if image else start
+        if image or pos == 0 or text[pos - 1] != '!':
+            stop = _plain_link_body(text, pos, last_paren, complete)
+            if stop is _nested:
+                if bodies is None:
+                    bodies = _link_bodies(text, complete)
+                stop = bodies[pos]
+        else:
+            stop = None
+        if stop is None:
+            start = text.find(token, start + 1)
+            continue
+        end = _link_target_end(text, stop + 2, title_end, complete) if stop is not _unknown else None
+        if end is None:
+            certain = start
+            break
+        parts.append(text[copied:start])
+        copied = end
+        start = text.find(token, end)
+    parts.append(text[copied:max(copied, certain)])
+    return text[:0].join(parts)
+
+
+def _strip_iframes(text, complete=True):
+    """_iframe.sub('', text), . does not cross a newline."""
+    if complete and '<iframe' not in text:
+        return text
+
+    closes = _Seeker(_iframe_close, text)
+    newlines = _Seeker(_newline, text)
+    parts = []
+    copied = 0
+    certain = len(text) if complete else _partial_tail(text, '<iframe')
+    pos = text.find('<iframe')
+    while pos != -1:
+        close = closes.find(pos + 7)
+        newline = newlines.find(pos + 7)
+        if close == -1 or (newline != -1 and newline < close):
+            if close == -1 and newline == -1 and not complete:
+                certain = pos
+                break
+            pos = text.find('<iframe', pos + 1)
+            continue
+        parts.append(text[copied:pos])
+        copied = close + 9
+        pos = text.find('<iframe', copied)
+    parts.append(text[copied:max(copied, certain)])
+    return text[:0].join(parts)
+
+
+def _strip_gengmei_links(text, complete=True):
+    """gengmei_link.sub('', text), . does not cross a newline."""
+    if complete and '](gengmei://' not in text:
+        return text
+
+    targets = _Seeker(_gengmei_target, text)
+    parens = _Seeker(_close_paren, text)
+    newlines = _Seeker(_newline, text)
+    parts = []
+    copied = 0
+    certain = len(text)
+    pos = text.find('[')
+    while pos != -1:
+        # the link must not span lines, neither before nor after ](gengmei://
+        target = targets.find(pos + 1)
+        newline = newlines.find(pos + 1)
+        paren = parens.find(target + 12) if target != -1 else -1
+        if paren == -1 or (newline != -1 and newline < paren):
+            if paren == -1 and newline == -1 and not complete:
+                certain = pos
+                break
+            pos = text.find('[', pos + 1)
+            continue
+        parts.append(text[copied:pos])
+        copied = paren + 1
+        pos = text.find('[', copied)
+    parts.append(text[copied:max(copied, certain)])
+    return text[:0].join(parts)
+
+
+def _strip_markdown(md_txt, keep_image, complete):
+    striped = _strip_links(md_txt, False, complete)
     if keep_image:
         return striped
 
-    striped = _image_link.sub('', striped)
-    striped = _iframe.sub('', striped)
-    striped = gengmei_link.sub('', striped)
+    striped = _strip_links(striped, True, complete)
+    striped = _strip_iframes(striped, complete)
+    striped = _strip_gengmei_links(striped, complete)
     return striped
 
 
-def _striper(x):
+def strip_markdown_links(md_txt, keep_image=False):
+    """strip markdown link and image."""
+    return _strip_markdown(md_txt, keep_image, True)
+
+
+def _striper(x, max_length=None):
+    """stripped x, with max_length only its first max_length characters.
+
+    strip_tags leaves a text without both < and > alone, the markdown of such
+    a text is stripped from a growing head until it gives max_length
+    characters, so a long post costs what its first lines cost.
+    """
+    if max_length is not None and not ('<' in x and '>' in x):
+        size = max(256, 2 * max_length)
+        while size < len(x):
+            head = _strip_markdown(x[:size], False, False)
+            if len(head.strip()) >= max_length:
+                return head.lstrip()[:max_length]
+            size *= 2
+
     _x = strip_tags(strip_markdown_links(x))
-    return _x.strip()
+    _x = _x.strip()
+    return _x if max_length is None else _x[:max_length]
 
 
 def patch_url_parameter(url, **kwargs):
@@ -60,31 +341,65 @@ def patch_url_parameter(url, **kwargs):
     return url + "&" + urlencode(kwargs) if "?" in url else url + "?" + urlencode(kwargs)
 
 
+def _copy_payload(payload):
+    """payload with dicts of its own, down to the per platform ones."""
+    return dict((k, dict(v) if isinstance(v, dict) else v) for k, v in payload.items())
+
+
 class ShareData(object):
     """
     分享数据结构
+
+    share_data and share_data_for_88 are built once, every access gets its
+    own copy to change; changing a field rebuilds them.
     """
+    __slots__ = (
+        'wechat_title', 'wechat_content', 'wechat_line', 'weibo', 'url', 'image', 'weibo_share_url',
+        '_share_data', '_share_data_for_88',
+    )
+
     weibo_share_max_length = 140
     weixin_content_max_length = 200
 
     def __init__(self, image=None, url='', wechat_title='', wechat_content='', wechat_line='', weibo='',):
-        self.wechat_title = _striper(wechat_title)
-        self.wechat_content = _striper(wechat_content)
-        self.wechat_line = _striper(wechat_line)
+        self._setup(_striper, image, url, wechat_title, wechat_content, wechat_line, weibo)
+
+    @classmethod
+    def bulk(cls, items):
+        """one ShareData per dict of constructor arguments, e.g. for every item of a feed.
+
+        texts repeated across items (the same title, a shared weibo suffix)
+        are stripped once.
+        """
+        stripped = {}
+
+        def striper(x, max_length):
+            try:
+                return stripped[x, max_length]
+            except KeyError:
+                value = stripped[x, max_length] = _striper(x, max_length)
+                return value
+
+        result = []
+        for item in items:
+            share = cls.__new__(cls)
+            share._setup(striper, **item)
+            result.append(share)
+        return result
+
+    def _setup(self, striper, image=None, url='', wechat_title='', wechat_content='', wechat_line='', weibo='',):
+        max_length = self.weixin_content_max_length
+        self.wechat_title = striper(wechat_title, max_length)
+        self.wechat_content = striper(wechat_content, max_length)
+        self.wechat_line = striper(wechat_line, max_length)
         self.weibo = weibo
         self.url = url
         self.image = image
         self.weibo_share_url = settings.WEIBO_SHARE_HOST
 
-        if len(self.wechat_title) > self.weixin_content_max_length:
-            self.wechat_title = self.wechat_title[0:self.weixin_content_max_length]
-        if len(self.wechat_content) > self.weixin_content_max_length:
-            self.wechat_content = self.wechat_content[0:self.weixin_content_max_length]
-        if len(self.wechat_line) > self.weixin_content_max_length:
-            self.wechat_line = self.wechat_line[0:self.weixin_content_max_length]
-
         if isinstance(self.weibo, (list, tuple)):
-            _weibo = [_striper(x) for x in weibo]
+            # one more character than fits still tells the parts are too long
+            _weibo = [striper(x, self.weibo_share_max_length + 1) for x in weibo]
             weibo_prefix, weibo_suffix = _weibo
             if len(weibo_suffix) > self.weibo_share_max_length:
                 self.weibo = weibo_suffix[0:self.weibo_share_max_length]
@@ -98,38 +413,32 @@ class ShareData(object):
         if self.image is None:
             self.image = Config.gengmei_icon
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            object.__setattr__(self, '_share_data', None)
+            object.__setattr__(self, '_share_data_for_88', None)
+
     @property
     def share_data(self):
-        result = {
-            'image': self.image,
-            'url': self.url,
-            'wechat': {
-                'title': self.wechat_title,
-                "content": self.wechat_content
-            },
-            'wechatline': {
-                'title': self.wechat_line,
-                'content': self.wechat_line
-            },
-            'qq': {
-                'title': self.wechat_title,
-                'content': self.wechat_content
-            },
-            'weibo': {
-                'title': self.weibo,
-                'content': self.weibo
-            }
-        }
+        if self._share_data is None:
+            self._build()
+        return _copy_payload(self._share_data)
+
+    @property
+    def share_data_for_88(self):
+        if self._share_data_for_88 is None:
+            self._build()
+        return _copy_payload(self._share_data_for_88)
 
+    def _build(self):
+        weibo_content = self.weibo
         """微博升级: 至少含有一个不跨域名的URL; 跟前面保持一个空格"""
-        if self.weibo_share_url not in result['weibo']['content']:
+        if self.weibo_share_url not in weibo_content:
             # 默认放在分享文字后面
-            result['weibo']['content'] = result['weibo']['content'][:self.weibo_share_max_length - len(self.weibo_share_url) - 1] \
-                                         + ' ' + self.weibo_share_url
-        return result
+            weibo_content = weibo_content[:self.weibo_share_max_length - len(self.weibo_share_url) - 1] \
+                            + ' ' + self.weibo_share_url
 
-    @property
-    def share_data_for_88(self):
         result = {
             'image': self.image,
             'url': self.url,
@@ -147,16 +456,57 @@ class ShareData(object):
             },
             'weibo': {
                 'title': self.weibo,
-                'content': self.weibo
-            },
-            'wechat_screenshot': Config.wechat_screenshot,
-            'wechatline_screenshot': Config.wechatline_screenshot
+                'content': weibo_content
+            }
         }
+        result_for_88 = _copy_payload(dict(
+            result,
+            wechat_screenshot=Config.wechat_screenshot,
+            wechatline_screenshot=Config.wechatline_screenshot,
+        ))
+        object.__setattr__(self, '_share_data', result)
+        object.__setattr__(self, '_share_data_for_88', result_for_88)
 
-        """微博升级: 至少含有一个不跨域名的URL; 跟前面保持一个空格"""
-        if self.weibo_share_url not in result['weibo']['content']:
-            # 默认放在分享文字后面
-            result['weibo']['content'] = result['weibo']['content'][
-                                         :self.weibo_share_max_length - len(self.weibo_share_url) - 1] \
-                                         + ' ' + self.weibo_share_url
-        return result
+
+def _share_payload_key(variant, item):
+    # lazy translations and other non json values are keyed by their text
+    fingerprint = json.dumps([share_payload_version, settings.WEIBO_SHARE_HOST, item], sort_keys=True,
+                             default=force_text)
+    return 'c:share:%s:%s' % (variant, hashlib.sha1(fingerprint).hexdigest())
+
+
+def get_share_payloads(items, for_88=False):
+    """share_data (share_data_for_88 with for_88) of ShareData(**item) for every item.
+
+    payloads are cached in redis under a hash of the arguments: one MGET for
+    all items, only the missing ones are built (see ShareData.bulk) and stored.
+    cached payloads come back from json, with unicode strings. when redis
+    fails every payload is built, none is stored.
+    """
+    variant = '88' if for_88 else 'std'
+    keys = [_share_payload_key(variant, item) for item in items]
+    if not keys:
+        return []
+
+    try:
+        cached = db.mget(keys)
+    except RedisError as e:
+        exception_logger.error(e)
+        cached = [None] * len(keys)
+    payloads = [json.loads(value) if value is not None else None for value in cached]
+    missing = [i for i, payload in enumerate(payloads) if payload is None]
+    if missing:
+        pipe = db.pipeline(transaction=False)
+        for i, share in zip(missing, ShareData.bulk([items[i] for i in missing])):
+            payloads[i] = share.share_data_for_88 if for_88 else share.share_data
+            pipe.setex(keys[i], share_payload_cache_ttl, json.dumps(payloads[i], default=force_text))
+        try:
+            pipe.execute()
+        except RedisError as e:
+            exception_logger.error(e)
+    return payloads
+
+
+def get_share_payload(for_88=False, **kwargs):
+    """cached ShareData(**kwargs).share_data, see get_share_payloads."""
+    return get_share_payloads([kwargs], for_88)[0]
@@ -0,0 +1,42 @@
+# coding=utf-8
+from gm_share.libs import metrics
+from gm_share.libs.pool import get_pool
+from gm_share.weixin.wx import async_pool_size, get_wechat_sdk, get_wx_api, sign_pool_size
+
+
+def _submit(func, *args, **kwargs):
+    return get_pool('wx', async_pool_size).apply_async(metrics.bind(func), args, kwargs)
+
+
+def _submit_sign(func, *args, **kwargs):
+    return get_pool('wx_sign', sign_pool_size).apply_async(metrics.bind(func), args, kwargs)
+
+
+class AsyncWxTkApi(object):
+    """non-blocking WxTkApi, every method returns an AsyncResult at once.
+
+    the call runs on the shared weixin thread pool; result.get(timeout)
+    returns what WxTkApi would, or raises the same WxTkApiErr.
+
+        api = AsyncWxTkApi()
+        pending = [api.get_sns_userinfo(at, openid) for at, openid in users]
+        infos = [p.get(timeout=5) for p in pending]
+    """
+
+    def __init__(self, wxapi=None):
+        self.wxapi = wxapi or get_wx_api()
+
+    def __getattr__(self, name):
+        method = getattr(self.wxapi, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        def submit(*args, **kwargs):
+            return _submit(method, *args, **kwargs)
+        submit.__name__ = name
+        return submit
+
+
+def get_wechat_sdk_async(absolute_url, app_id=None):
+    """get_wechat_sdk on the page signing thread pool, returns an AsyncResult."""
+    return _submit_sign(get_wechat_sdk, absolute_url, app_id)
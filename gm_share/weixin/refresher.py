@@ -0,0 +1,87 @@
+# coding=utf-8
+import random
+import threading
+
+from django.conf import settings
+
+from gm_share.libs.log import error_logger, info_logger
+from gm_share.weixin.wx import credential_expires_in, get_registered_app_ids, get_wx_api
+
+
+# lifetime weixin grants access_token and jsapi_ticket, minus the minute we expire early
+credential_lifetime = 7200 - 60
+# renew once this fraction of the lifetime has passed
+refresh_ahead_ratio = getattr(settings, 'WX_REFRESH_AHEAD_RATIO', 0.5)
+# upper bound between two checks, so a credential deleted by hand is noticed soon
+check_interval = getattr(settings, 'WX_REFRESH_CHECK_INTERVAL', 60)
+backoff_base = 1
+backoff_max = 60
+
+
+class CredentialRefresher(threading.Thread):
+    """renew weixin credentials in the background, so no request waits on weixin.
+
+    runs either as a daemon thread in every worker (see start_refresher) or
+    in the foreground through the refresh_wx_credentials management command;
+    any number of refreshers may run, the refresh lock lets one of them call weixin.
+    one refresher serves every registered app unless given its own wxapis.
+    """
+
+    def __init__(self, wxapis=None):
+        super(CredentialRefresher, self).__init__(name='wx-credential-refresher')
+        self.daemon = True
+        self.wxapis = wxapis
+        self.min_ttl = credential_lifetime * (1 - refresh_ahead_ratio)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def refresh(self):
+        """refresh what is due, return seconds until the next check.
+
+        an app that fails does not hold back the others, the first error is
+        raised once all of them were tried.
+        """
+        wxapis = self.wxapis or [get_wx_api(app_id) for app_id in get_registered_app_ids()]
+        error = None
+        ttl = check_interval + self.min_ttl
+        for wxapi in wxapis:
+            try:
+                wxapi.refresh_credentials(self.min_ttl)
+            except Exception as e:
+                error_logger.error(u'刷新微信凭证报错 app_id:%s, %s', wxapi.app_id, e)
+                error = error or e
+                continue
+            ttl = min(ttl, credential_expires_in(wxapi.access_token_key), credential_expires_in(wxapi.jsapi_ticket_key))
+        if error is not None:
+            raise error
+        return max(1, min(check_interval, ttl - self.min_ttl))
+
+    def run(self):
+        info_logger.info(u'weixin credential refresher started')
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                wait = self.refresh()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                # full jitter, so refreshers of all workers do not retry in lockstep
+                wait = random.uniform(backoff_base, min(backoff_max, backoff_base * 2 ** failures))
+                error_logger.error(u'刷新微信凭证报错 %s, %s 秒后重试', e, wait)
+            self._stopped.wait(wait)
+
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def start_refresher():
+    """start the refresher thread of this process once, call it after the worker forked."""
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = CredentialRefresher()
+            _refresher.start()
+    return _refresher
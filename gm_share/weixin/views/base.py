@@ -2,12 +2,16 @@
 
 from __future__ import unicode_literals
 
+import hashlib
 import inspect
 import json
 import re
 import sys
 import time
 import traceback
+import uuid
+import zlib
+from multiprocessing import TimeoutError
 from urllib import urlencode
 
 import helios.rpc
@@ -16,45 +20,62 @@ from django.conf import settings, urls
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import force_bytes
 from gm_logging.django.middleware import get_client_info_of_request
 from gm_types.error import ERROR
 from helios.rpc.exceptions import RPCFaultException
+from redis import RedisError
 
 from gm_share.commons.enums import RPC_ERROR_CODE
 from gm_share.commons.common import *
-from gm_share.libs.redis_db import db as cache
+from gm_share.commons.user_agent import classify_user_agent
+from gm_share.libs import metrics, session_user
+from gm_share.libs.redis_db import db as cache, release_lock_script
 from gm_share.libs.log import error_logger, exception_logger, info_logger
-from gm_share.libs.rpc import get_base_rpc_invoker
-from gm_share.weixin.wx import WxTkApi, WxTkApiErr
+from gm_share.libs.rpc import BatchedRPCResult, BatchingInvoker, CountingInvoker, get_base_rpc_invoker
+from gm_share.weixin.async_wx import get_wechat_sdk_async
+from gm_share.weixin.views.fetch import FetchTask, run_fetch_tasks, submit
+from gm_share.weixin.wx import WxTkApiErr, empty_wechat_sdk, get_wechat_sdk, get_wx_api
 
 
-_context_key = '_the_long_long_long_name_for_dict'
+# seconds stage_decorate waits for the user info rpc and weixin signing running side by side,
+# both counted from when they were started
+decorate_user_info_timeout = getattr(settings, 'VIEW_DECORATE_USER_INFO_TIMEOUT', 3)
+decorate_wechat_sdk_timeout = getattr(settings, 'VIEW_DECORATE_WECHAT_SDK_TIMEOUT', 3)
+
+# add a Server-Timing header with stage durations and backend call counts to every response
+server_timing_enabled = getattr(settings, 'VIEW_SERVER_TIMING', False)
+
+# seconds the request rebuilding a page may hold its lock, must outlive rendering
+page_cache_lock_timeout = getattr(settings, 'PAGE_CACHE_LOCK_TIMEOUT', 10)
+# seconds a request waits for a page another request renders, then renders it too
+page_cache_wait_timeout = getattr(settings, 'PAGE_CACHE_WAIT_TIMEOUT', 1)
+page_cache_wait_interval = 0.05
+# gzip level of cached pages, they are compressed once and served as is to gzip clients
+page_cache_compress_level = getattr(settings, 'PAGE_CACHE_COMPRESS_LEVEL', 6)
+
+_accepts_gzip = re.compile(r'\bgzip\b')
 
 
 class Context(object):
-    def __init__(self):
-        self.__dict__[_context_key] = dict()
+    """values of one request, ctx.name and ctx['name'] are the same entry.
+
+    entries live right in the instance __dict__, so reading ctx.name is a
+    plain attribute lookup rather than a call to __getattr__.
+    """
 
     def __getitem__(self, item):
-        return self.__dict__[_context_key][item]
+        return self.__dict__[item]
 
     def __setitem__(self, key, value):
-        self.__dict__[_context_key][key] = value
+        self.__dict__[key] = value
 
     def __delitem__(self, key):
-        del self.__dict__[_context_key][key]
+        del self.__dict__[key]
 
-    def __getattr__(self, item):
-        try:
-            return self.__dict__[_context_key][item]
-        except KeyError:
-            raise AttributeError(item)
-
-    def __setattr__(self, key, value):
-        self.__dict__[_context_key][key] = value
-
-    def __delattr__(self, item):
-        del self.__dict__[_context_key][item]
+    def __contains__(self, item):
+        return item in self.__dict__
 
 
 def extract_context(obj):
@@ -69,8 +90,8 @@ def extract_context(obj):
     if isinstance(obj, (list, tuple)):
         return [extract_context(x) for x in obj]
     if isinstance(obj, Context):
-        return extract_context(getattr(obj, _context_key))
-    if isinstance(obj, helios.rpc.RPCResult):
+        return extract_context(obj.__dict__)
+    if isinstance(obj, (helios.rpc.RPCResult, BatchedRPCResult)):
         try:
             return ['RPCResult', obj.unwrap()]
         except:
@@ -104,6 +125,18 @@ def get_url_patterns_from_modules(prefix, modules):
     return urls.patterns(prefix, *url_entry_list)
 
 
+_stages = {}
+
+
+def _parse_stage(stage):
+    """'decorate!' -> ('decorate', 'stage_decorate', True), a trailing ! keeps the result out of ctx."""
+    parsed = _stages.get(stage)
+    if parsed is None:
+        name = stage.rstrip('!')
+        parsed = _stages[stage] = (name, 'stage_' + name, stage.endswith('!'))
+    return parsed
+
+
 class FastHttpResponse(Exception):
     def __init__(self, response):
         self.response = response
@@ -125,6 +158,12 @@ class BaseView(object):
 
     decorators = ()
 
+    # {name: FetchTask}, run concurrently by stage_fetch, results land in ctx.fetch
+    fetch_tasks = None
+
+    # per view switch of the Server-Timing header, see VIEW_SERVER_TIMING
+    server_timing = server_timing_enabled
+
     def get_error_message_from_errorcode(self, code, default=u'服务器开小差啦~'):
         return ERROR.getDesc(code, default)
 
@@ -155,6 +194,8 @@ class BaseView(object):
         return self.handle_init(ctx, *ctx.args, **ctx.kwargs)
 
     def stage_fetch(self, ctx):
+        if self.fetch_tasks:
+            return run_fetch_tasks(self, ctx, self.fetch_tasks)
         return {}
 
     def stage_transform(self, ctx):
@@ -173,19 +214,21 @@ class BaseView(object):
         pass
 
     def run_stage(self, stage, ctx):
-        proc = False
-        if stage.endswith('!'):
-            stage = stage[:-1]
-            proc = True
-        func = getattr(self, 'stage_' + stage)
-        ret = func(ctx)
+        stage, method, proc = _parse_stage(stage)
+        ret = getattr(self, method)(ctx)
         if not proc:
             ctx[stage] = ret
             ctx.prev = ret
 
     def process(self, ctx):
+        timings = metrics.current()
         for stage in self.stage_list:
-            self.run_stage(stage, ctx)
+            started = time.time()
+            try:
+                self.run_stage(stage, ctx)
+            finally:
+                if timings is not None:
+                    timings.add_stage(_parse_stage(stage)[0], time.time() - started)
 
     def dispatch_ctx(self, ctx):
         try:
@@ -215,7 +258,13 @@ class BaseView(object):
             ctx.logger = request.logger
         except AttributeError:
             pass
-        self.dispatch_ctx(ctx)
+        timings = metrics.start(self.url_name or self.__class__.__name__)
+        try:
+            self.dispatch_ctx(ctx)
+        finally:
+            metrics.finish(timings)
+        if self.server_timing and isinstance(ctx.response, HttpResponse):
+            ctx.response['Server-Timing'] = timings.server_timing()
         return ctx.response
 
     def __init__(self):
@@ -253,6 +302,14 @@ class BaseView(object):
 
 
 class CommonView(BaseView):
+    # 同一 stage 内的 rpc 调用合并去重后一起发出, 见 BatchingInvoker
+    rpc_batching = False
+
+    def run_stage(self, stage, ctx):
+        super(CommonView, self).run_stage(stage, ctx)
+        if self.rpc_batching and 'rpc' in ctx:
+            # calls whose results were never used still go out with their stage
+            ctx.rpc.flush()
 
     def stage_pre(self, ctx):
         super(CommonView, self).stage_pre(ctx)
@@ -264,10 +321,12 @@ class CommonView(BaseView):
 
         client_info = get_client_info_of_request(req)
 
-        ctx.rpc = get_base_rpc_invoker().with_config(
+        ctx.rpc = CountingInvoker(get_base_rpc_invoker().with_config(
             session_key=session_key,
             client_info=client_info,
-        )
+        ))
+        if self.rpc_batching:
+            ctx.rpc = BatchingInvoker(ctx.rpc)
 
         self.is_hybrid = False
         ctx.is_hybrid = False
@@ -278,30 +337,7 @@ class CommonView(BaseView):
         # 根据UA判断是iOS还是Android
         user_agent = ctx.request.META.get('HTTP_USER_AGENT')
         ctx.user_agent = user_agent
-
-        def get_client_and_platform(user_agent=None):
-            from_client = False
-            platform = None
-            if re.search(r'Gengmei', user_agent, re.IGNORECASE):
-                from_client = True
-            if re.search(r'gmdoctor', user_agent, re.IGNORECASE):
-                from_client = True
-
-            if (
-                    re.search(r'iPhone', user_agent, re.IGNORECASE) or
-                    re.search(r'iPad', user_agent, re.IGNORECASE)
-            ):
-                platform = PLATFORM_TYPE.IOS
-            elif re.search(r'Android', user_agent, re.IGNORECASE):
-                platform = PLATFORM_TYPE.ANDROID
-            else:
-                platform = PLATFORM_TYPE.PC
-            return platform, from_client
-        if not user_agent:
-            ctx.platform = PLATFORM_TYPE.UNKNOWN
-            ctx.from_client = False
-        else:
-            ctx.platform, ctx.from_client = get_client_and_platform(user_agent)
+        ctx.platform, ctx.from_client, ctx.app_version = classify_user_agent(user_agent)
 
     if settings.DEBUG:
         def dispatch_ctx(self, ctx):
@@ -360,6 +396,14 @@ class CommonView(BaseView):
                 )
 
 
+def _wait(async_result, started, timeout, default):
+    try:
+        return async_result.get(max(0, started + timeout - time.time()))
+    except TimeoutError:
+        error_logger.error(u'decorate 等待超时 %ss', timeout)
+        return default
+
+
 def _login_url(ctx):
     login = reverse('login')
     if ctx.request.method.lower() == 'get':
@@ -375,6 +419,8 @@ class TemplateView(CommonView):
     template_smart_lookup = False
     # 是否返回微信签名 默认不返回
     return_weixin_config = False
+    # 签名所用的公众号, 默认 settings.WX_APP_ID
+    weixin_app_id = None
 
     def stage_pre(self, ctx):
         super(TemplateView, self).stage_pre(ctx)
@@ -389,36 +435,49 @@ class TemplateView(CommonView):
             'has_login': ctx.session_key is not None,
         }
 
-        if ctx.session_key:
-            try:
-                user_info = ctx.rpc['api/user_info']().unwrap()
-                obj['current_user'] = user_info['user_id']
-            except:
-                obj['current_user'] = None
+        if ctx.session_key and self.return_weixin_config:
+            # user info rpc and weixin signing do not depend on each other
+            started = time.time()
+            user_id = submit(self.get_current_user, ctx)
+            wechat_sdk = get_wechat_sdk_async(ctx.request.build_absolute_uri(), self.weixin_app_id)
+            obj['current_user'] = _wait(user_id, started, decorate_user_info_timeout, None)
+            obj.update(_wait(wechat_sdk, started, decorate_wechat_sdk_timeout, empty_wechat_sdk()))
         else:
-            obj['current_user'] = None
-
-        if self.return_weixin_config:
-            try:
-                wxapi = WxTkApi()
-                access_token = wxapi.get_access_token()
-                jsapi_ticket = wxapi.get_jsapi_ticket(access_token)
-                wxconfig = wxapi.get_jsapi_sign(jsapi_ticket, ctx.request.build_absolute_uri())
-                obj['wechat_sdk'] = wxconfig
-                obj['wechat_sdk']['appId'] = settings.WX_APP_ID
-            except Exception as e:
-                error_logger.error(u'取微信签名报错 %s', e.message)
-                obj['wechat_sdk'] = {
-                    'nonceStr': '',
-                    'jsapi_ticket': '',
-                    'timestamp': '',
-                    'url': '',
-                    'appId': ''
-                }
+            obj['current_user'] = self.get_current_user(ctx) if ctx.session_key else None
+            if self.return_weixin_config:
+                obj.update(get_wechat_sdk(ctx.request.build_absolute_uri(), self.weixin_app_id))
 
         channel = ctx.request.COOKIES.get(Config.channel_cookie_name)
         obj['download_url'] = get_download_url_from_channel(channel, ctx.platform)
 
+    def get_current_user(self, ctx):
+        """user_id of the session, None if the backend does not know it."""
+        try:
+            return ctx.current_user_id
+        except AttributeError:
+            pass
+
+        try:
+            user_id = session_user.get_user_id(ctx.session_key)
+        except RedisError as e:
+            # the cache only spares the rpc, ask the backend
+            exception_logger.error(e)
+            user_id = None
+
+        if user_id is None:
+            try:
+                user_info = ctx.rpc['api/user_info']().unwrap()
+                user_id = user_info['user_id']
+            except:
+                user_id = None
+            else:
+                try:
+                    session_user.set_user_id(ctx.session_key, user_id)
+                except RedisError as e:
+                    exception_logger.error(e)
+        ctx.current_user_id = user_id
+        return user_id
+
     def stage_render(self, ctx):
         obj = ctx.prev
         return render(ctx.request, ctx.template, obj)
@@ -464,7 +523,7 @@ class WeixinLoginRequiredMixin(object):
 
     def _redirect_to_authurl(self):
         redirect_url = self.ctx.request.build_absolute_uri()
-        redirect_url = WxTkApi().get_auth_url(redirect_url, scope='snsapi_userinfo')
+        redirect_url = get_wx_api().get_auth_url(redirect_url, scope='snsapi_userinfo')
         raise FastHttpResponse(HttpResponseRedirect(redirect_url))
 
     def save_accesstoken_to_session(self, at):
@@ -476,7 +535,7 @@ class WeixinLoginRequiredMixin(object):
         if born_at + at['expires_in'] < now:
             try:
                 refresh_token = at['refresh_token']
-                res = WxTkApi().get_accesstoken_by_refresh(refresh_token=refresh_token)
+                res = get_wx_api().get_accesstoken_by_refresh(refresh_token=refresh_token)
                 res = self._update_accesstoken(res)
                 self.save_accesstoken_to_session(res)
                 return True
@@ -513,7 +572,7 @@ class WeixinLoginRequiredMixin(object):
             # check is callback from weixin
             try:
                 code = self.ctx.request.GET.get('code')
-                res = WxTkApi().get_sns_access_token(code=code)
+                res = get_wx_api().get_sns_access_token(code=code)
                 res = self._update_accesstoken(res)
                 self.save_accesstoken_to_session(res)
                 access_token = res
@@ -523,7 +582,7 @@ class WeixinLoginRequiredMixin(object):
 
             # first time in, log userinfo
             try:
-                user_data = WxTkApi().get_sns_userinfo(access_token['access_token'], access_token['openid'])
+                user_data = get_wx_api().get_sns_userinfo(access_token['access_token'], access_token['openid'])
                 info_logger.info(user_data)
             except Exception as e:
                 exception_logger.error(e)
@@ -556,22 +615,163 @@ class WexinLoginRequiredJsonView(JsonView, WeixinLoginRequiredMixin):
 
 
 class CacheMixinForHtml(object):
+    """full page cache of a TemplateView, put it before the view in the bases.
+
+    with page_cache_seconds set, a GET is answered from redis in stage_init,
+    before anything is fetched, and a page rendered with status 200 is cached
+    in stage_post. pages vary by platform, login state (one copy per session
+    since current_user is rendered in) and download channel, see
+    get_page_cache_variant. for page_cache_stale_seconds after it went stale a
+    page is still served while the one request holding the rebuild lock renders
+    it again, so an expiring popular page does not hit the backend all at once.
+    """
+
+    # seconds a cached page is fresh, None turns the automatic cache off
+    page_cache_seconds = None
+    # seconds a stale page is still served while it is being rebuilt
+    page_cache_stale_seconds = getattr(settings, 'PAGE_CACHE_STALE_SECONDS', 60)
 
     def get_page_cache_key(self, key_suffix=''):
         return 'c:%s:ps:%s' % (self.url_name, key_suffix)
 
-    def return_from_cache_direclty(self, key_suffix=''):
-        """get cached page from cache.
+    def get_page_cache_suffix(self, ctx):
+        """what the page depends on besides the variant, the full path by default."""
+        return hashlib.md5(force_bytes(ctx.request.get_full_path())).hexdigest()
+
+    def get_page_cache_variant(self, ctx):
+        if ctx.session_key:
+            login = hashlib.sha1(force_bytes(ctx.session_key)).hexdigest()[:16]
+        else:
+            login = 'anon'
+        channel = ctx.request.COOKIES.get(Config.channel_cookie_name)
+        if channel not in DOWNLOAD_URL:
+            # unknown channels all get the default download url
+            channel = 'default'
+        variant = '%s:%s:%s' % (ctx.platform, login, channel)
+        if getattr(self, 'return_weixin_config', False):
+            # the jsapi signature covers the absolute url, host included
+            variant += ':' + hashlib.md5(force_bytes(ctx.request.build_absolute_uri())).hexdigest()
+        return variant
+
+    def _page_cache_key(self, ctx, key_suffix):
+        return '%s:%s' % (self.get_page_cache_key(key_suffix), self.get_page_cache_variant(ctx))
+
+    def stage_init(self, ctx):
+        if self.page_cache_seconds:
+            self.return_from_cache(ctx, self.get_page_cache_suffix(ctx))
+        return super(CacheMixinForHtml, self).stage_init(ctx)
+
+    def stage_post(self, ctx):
+        super(CacheMixinForHtml, self).stage_post(ctx)
+        if self.page_cache_seconds:
+            self.cache_render_page(ctx, self.page_cache_seconds, self.get_page_cache_suffix(ctx))
+
+    def dispatch_ctx(self, ctx):
+        try:
+            super(CacheMixinForHtml, self).dispatch_ctx(ctx)
+        finally:
+            # also when the page was never rendered: errors, FastHttpResponse, login redirects
+            lock = ctx.page_cache_lock if 'page_cache_lock' in ctx else None
+            if lock is not None:
+                release_lock_script(keys=[lock[0]], args=[lock[1]])
+                ctx.page_cache_lock = None
+
+    def return_from_cache_direclty(self, key_suffix='', ctx=None):
+        """get cached page from cache, see return_from_cache.
+
+        without ctx it does nothing, as up to 0.1.18.
+        """
+        if ctx is not None:
+            self.return_from_cache(ctx, key_suffix)
+
+    def return_from_cache(self, ctx, key_suffix=''):
+        """get cached page of ctx's request from cache.
 
         NOTE: this will raise FastHttpResponse
         """
-        k = self.get_page_cache_key(key_suffix)
-        html = cache.get(k)
-        if html:
-            #raise FastHttpResponse(HttpResponse(html))
-            pass
+        if ctx.request.method != 'GET' or (settings.DEBUG and 'debug' in ctx.request.GET):
+            return
+
+        k = self._page_cache_key(ctx, key_suffix)
+        body, fresh, compressed = _load_page(k)
+        if body is not None and fresh:
+            raise FastHttpResponse(_page_response(ctx.request, body, compressed, 'hit'))
+
+        lock_key = k + ':lock'
+        lock_token = uuid.uuid4().hex
+        if cache.set(lock_key, lock_token, ex=page_cache_lock_timeout, nx=True):
+            # we rebuild the page, dispatch_ctx gives the lock back
+            ctx.page_cache_lock = (lock_key, lock_token)
+            return
+
+        if body is not None:
+            raise FastHttpResponse(_page_response(ctx.request, body, compressed, 'stale'))
+
+        # a miss another request is already rendering, wait for its result a little
+        deadline = time.time() + page_cache_wait_timeout
+        while time.time() < deadline:
+            time.sleep(page_cache_wait_interval)
+            body, _, compressed = _load_page(k)
+            if body is not None:
+                raise FastHttpResponse(_page_response(ctx.request, body, compressed, 'hit'))
 
     def cache_render_page(self, ctx, seconds, key_suffix=''):
-        """cache rendered html to redis."""
-        k = self.get_page_cache_key(key_suffix)
-        cache.setex(k, seconds, ctx.render.content)
+        """cache rendered html to redis.
+
+        pages middleware adds a cookie to later are not cached: one with a
+        csrf token, or rendered from the session (which also makes it vary by
+        Cookie), would be served to other visitors of the same variant.
+        """
+        response = ctx.render
+        session = getattr(ctx.request, 'session', None)
+        if (
+                ctx.request.method == 'GET' and
+                isinstance(response, HttpResponse) and
+                response.status_code == 200 and
+                not response.cookies and
+                not ctx.request.META.get('CSRF_COOKIE_USED') and
+                not getattr(session, 'accessed', False)
+        ):
+            fresh_until = int(time.time()) + seconds
+            k = self._page_cache_key(ctx, key_suffix)
+            body = b'gz|%d|' % fresh_until + _compress_page(response.content)
+            cache.setex(k, seconds + self.page_cache_stale_seconds, body)
+
+
+def _load_page(key):
+    """(body, fresh, compressed) of a cached page, body is None on a miss.
+
+    pages are stored as gz|<fresh until>|<gzip of html>, entries written
+    before compression as <fresh until>|<html> are still read.
+    """
+    value = cache.get(key)
+    if not value:
+        return None, False, False
+    compressed = value.startswith(b'gz|')
+    if compressed:
+        value = value[3:]
+    fresh_until, _, body = value.partition(b'|')
+    try:
+        fresh_until = int(fresh_until)
+    except ValueError:
+        return None, False, False
+    return body, time.time() < fresh_until, compressed
+
+
+def _compress_page(html):
+    compressor = zlib.compressobj(page_cache_compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(html) + compressor.flush()
+
+
+def _page_response(request, body, compressed, state):
+    if not compressed:
+        response = HttpResponse(body)
+    elif _accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        # already compressed, GZipMiddleware leaves a response with Content-Encoding alone
+        response = HttpResponse(body)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response['X-Page-Cache'] = state
+    return response
@@ -0,0 +1,82 @@
+# coding=utf-8
+import sys
+from Queue import Queue
+
+import six
+from django.conf import settings
+
+from gm_share.libs import metrics
+from gm_share.libs.pool import get_pool
+
+
+# threads per process running fetch tasks of all views
+fetch_pool_size = getattr(settings, 'VIEW_FETCH_POOL_SIZE', 16)
+
+
+class FetchTask(object):
+    """one named call of the fetch stage, see BaseView.fetch_tasks.
+
+    func is the name of a view method (or any callable) called as
+    func(ctx, **results_of_deps); tasks that do not depend on each other run
+    concurrently, so they must not touch ctx beyond reading it.
+    """
+
+    def __init__(self, func, deps=()):
+        self.func = func
+        self.deps = tuple(deps)
+
+
+def submit(func, *args, **kwargs):
+    """run func on the fetch pool, returns an AsyncResult."""
+    return get_pool('fetch', fetch_pool_size).apply_async(metrics.bind(func), args, kwargs)
+
+
+def run_fetch_tasks(view, ctx, tasks):
+    """run the task graph on the fetch pool, return {name: result}.
+
+    the first task that raises stops the stage, its exception (e.g. a
+    RPCFaultException) is re-raised here with its original traceback.
+    """
+    for name, task in tasks.items():
+        for dep in task.deps:
+            if dep not in tasks:
+                raise ValueError('fetch task %s depends on unknown task %s' % (name, dep))
+
+    def call(name):
+        task = tasks[name]
+        func = getattr(view, task.func) if isinstance(task.func, six.string_types) else task.func
+        return func(ctx, **dict((dep, results[dep]) for dep in task.deps))
+
+    results = {}
+    if len(tasks) == 1:
+        name, task = list(tasks.items())[0]
+        # with deps it depends on itself, the cycle is reported below
+        if not task.deps:
+            results[name] = call(name)
+            return results
+
+    done = Queue()
+
+    def run(name):
+        try:
+            done.put((name, call(name), None))
+        except:
+            done.put((name, None, sys.exc_info()))
+
+    pending = dict(tasks)
+    running = 0
+    while pending or running:
+        ready = [name for name, task in pending.items() if all(dep in results for dep in task.deps)]
+        for name in ready:
+            del pending[name]
+            submit(run, name)
+            running += 1
+        if not running:
+            raise ValueError('fetch tasks have a dependency cycle: %s' % ', '.join(sorted(pending)))
+
+        name, result, exc_info = done.get()
+        running -= 1
+        if exc_info is not None:
+            six.reraise(*exc_info)
+        results[name] = result
+    return results
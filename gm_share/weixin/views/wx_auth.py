@@ -1,10 +1,22 @@
 # coding=utf-8
+import hashlib
+import json
 from urllib import urlencode
 
+from django.conf import settings
 from django.views.generic.base import RedirectView
+from redis import RedisError
 
 from base import TemplateView
-from gm_share.weixin.wx import WxTkApi
+from gm_share.libs.log import exception_logger
+from gm_share.libs.redis_db import db
+from gm_share.weixin.wx import WxTkApiErr, get_wx_api
+
+
+# seconds the normalized weixin user info of an openid is reused
+sns_userinfo_cache_ttl = getattr(settings, 'WX_SNS_USERINFO_CACHE_TTL', 300)
+# seconds a failed lookup is remembered, so reloads do not hammer weixin
+sns_userinfo_negative_ttl = getattr(settings, 'WX_SNS_USERINFO_NEGATIVE_TTL', 10)
 
 
 class AuthView(RedirectView):
@@ -16,7 +28,7 @@ class AuthView(RedirectView):
             redirect_url = self.request.GET.get('redirect_url')
 
             try:
-                res = WxTkApi().get_sns_access_token(code=code)
+                res = get_wx_api().get_sns_access_token(code=code)
                 sns_access_token = res['access_token']
                 sns_openid = res['openid']
             except Exception as e:
@@ -33,7 +45,7 @@ class AuthView(RedirectView):
                 pass
             else:
                 redirect_url = self.request.build_absolute_uri()
-            auth_url = WxTkApi().get_auth_url(redirect_url, scope='snsapi_userinfo')
+            auth_url = get_wx_api().get_auth_url(redirect_url, scope='snsapi_userinfo')
 
             return auth_url
 
@@ -45,18 +57,7 @@ class WeixinAuthBaseView(TemplateView):
         if source and source == 'weixin':
             openid = ctx.request.GET['openid']
             access_token = ctx.request.GET['access_token']
-            wxapi = WxTkApi()
-            weixin_user_info = wxapi.get_sns_userinfo(access_token, openid)
-            nickname = weixin_user_info['nickname']
-            try:
-                nickname = ''.join([chr(ord(x)) for x in nickname]).decode('utf-8')
-            except:
-                pass
-            weixin_user_info = {
-                'nickname': nickname,
-                'headimgurl': weixin_user_info['headimgurl'],
-                'openid': weixin_user_info['openid']
-            }
+            weixin_user_info = self.get_weixin_user_info(openid, access_token)
 
             # normal_accessk_token = wxapi.get_access_token()
             # user_info = wxapi.get_user_info(normal_accessk_token, openid)
@@ -68,3 +69,44 @@ class WeixinAuthBaseView(TemplateView):
             ctx['weixin_user_info'] = weixin_user_info
             ctx['wechat_attention'] = True
 
+    def get_weixin_user_info(self, openid, access_token):
+        # access_token is part of the key, knowing an openid alone must not reveal the profile
+        key = 'wx:sns_userinfo:%s:%s' % (openid, hashlib.md5(access_token.encode('utf-8')).hexdigest())
+        try:
+            cached = db.get(key)
+        except RedisError as e:
+            # the cache only spares weixin calls, ask weixin
+            exception_logger.error(e)
+            cached = None
+        if cached is not None:
+            weixin_user_info = json.loads(cached)
+            if weixin_user_info is None:
+                # weixin failed on this user moments ago
+                raise WxTkApiErr('error', None)
+            return weixin_user_info
+
+        try:
+            weixin_user_info = get_wx_api().get_sns_userinfo(access_token, openid)
+        except WxTkApiErr:
+            _cache_sns_userinfo(key, sns_userinfo_negative_ttl, None)
+            raise
+
+        nickname = weixin_user_info['nickname']
+        try:
+            nickname = ''.join([chr(ord(x)) for x in nickname]).decode('utf-8')
+        except:
+            pass
+        weixin_user_info = {
+            'nickname': nickname,
+            'headimgurl': weixin_user_info['headimgurl'],
+            'openid': weixin_user_info['openid']
+        }
+        _cache_sns_userinfo(key, sns_userinfo_cache_ttl, weixin_user_info)
+        return weixin_user_info
+
+
+def _cache_sns_userinfo(key, seconds, weixin_user_info):
+    try:
+        db.setex(key, seconds, json.dumps(weixin_user_info))
+    except RedisError as e:
+        exception_logger.error(e)
@@ -1,22 +1,218 @@
 # coding=utf-8
 
+import binascii
 import hashlib
 import json
-import random
-import string
+import os
 import time
-from datetime import timedelta, datetime
+import urlparse
+import uuid
+from datetime import datetime, timedelta
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from urllib import urlencode
 
 import requests
 from django.conf import settings
-from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
-from gm_share.libs.redis_db import db
+from gm_share.libs import metrics
+from gm_share.libs.circuit_breaker import CircuitBreaker
+from gm_share.libs.local_cache import LocalCache
+from gm_share.libs.redis_db import db, release_lock_script
 from gm_share.libs.log import info_logger, exception_logger, error_logger
 
 
-datetime_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+# seconds a refresh lock may be held, must outlive the 4s weixin request timeout
+token_lock_timeout = getattr(settings, 'WX_TOKEN_LOCK_TIMEOUT', 10)
+# seconds a caller waits for another worker to publish a refreshed credential
+token_wait_timeout = getattr(settings, 'WX_TOKEN_WAIT_TIMEOUT', 5)
+token_wait_interval = 0.05
+# seconds a credential may live in the process before redis is asked again,
+# bounds how long a worker keeps using a token after another one refreshed it
+local_cache_ttl = getattr(settings, 'WX_LOCAL_CACHE_TTL', 60)
+
+# expiry format of the <key>:expired_time keys written before 0.1.4, utc
+legacy_datetime_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# app_id -> app_secret of the official accounts served besides WX_APP_ID
+wx_apps = dict(getattr(settings, 'WX_APPS', {}))
+
+# threads of the gm_share.weixin.async_wx pools, every one may hold a connection to weixin:
+# calls in flight per process, and signing for pages, which bulk AsyncWxTkApi jobs can not hold up
+async_pool_size = getattr(settings, 'WX_ASYNC_POOL_SIZE', 32)
+sign_pool_size = getattr(settings, 'WX_SIGN_POOL_SIZE', 16)
+# keep-alive connections to weixin, shared by every WxTkApi of a process; with
+# fewer than threads calling weixin the extra connections are opened and thrown away
+http_pool_size = getattr(settings, 'WX_HTTP_POOL_SIZE', async_pool_size + sign_pool_size)
+http_connect_timeout = getattr(settings, 'WX_HTTP_CONNECT_TIMEOUT', 2)
+http_read_timeout = getattr(settings, 'WX_HTTP_READ_TIMEOUT', 4)
+# retries of GETs on connect errors and 5xx, read timeouts are never retried
+http_max_retries = getattr(settings, 'WX_HTTP_MAX_RETRIES', 1)
+
+# stop calling weixin for a while once too many calls time out or fail,
+# pages then get the empty wechat_sdk at once, see wx_breaker.stats()
+wx_breaker = CircuitBreaker(
+    'weixin',
+    failure_rate=getattr(settings, 'WX_BREAKER_FAILURE_RATE', 0.5),
+    min_calls=getattr(settings, 'WX_BREAKER_MIN_CALLS', 10),
+    window=getattr(settings, 'WX_BREAKER_WINDOW', 30),
+    cooldown=getattr(settings, 'WX_BREAKER_COOLDOWN', 30),
+)
+
+# bytes read at a time when streaming media
+media_chunk_size = 64 * 1024
+
+# most openids weixin accepts in one user/info/batchget call
+user_info_batch_size = 100
+
+# reuse jsapi signatures of the same ticket and url instead of signing every page view
+jsapi_sign_cache_enabled = getattr(settings, 'WX_JSAPI_SIGN_CACHE', False)
+jsapi_sign_cache_size = getattr(settings, 'WX_JSAPI_SIGN_CACHE_SIZE', 1000)
+
+# L1 for access_token and jsapi_ticket, see credential_cache.stats() for hit rates
+credential_cache = LocalCache()
+# key -> (credential, unix timestamp it expires at in redis), last seen by this process
+credential_expiry = {}
+# (jsapi_ticket, url) -> signature, entries never outlive the cached ticket
+jsapi_sign_cache = LocalCache(maxsize=jsapi_sign_cache_size)
+
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """process wide pooled session, a forked child builds its own."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        retry = Retry(
+            total=http_max_retries,
+            read=False,
+            backoff_factor=0.1,
+            status_forcelist=(500, 502, 503, 504),
+            method_whitelist=frozenset(['GET']),
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=http_pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def _write_chunks(f, chunks):
+    size = 0
+    for chunk in chunks:
+        f.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def _normalize_sign_url(url):
+    # weixin signs the url without fragment, scheme and host are case insensitive
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((scheme.lower(), netloc.lower(), path, query, ''))
+
+
+def _cache_locally(key, value, expires_in):
+    now = time.time()
+    credential_cache.set(key, value, now + min(expires_in, local_cache_ttl))
+    credential_expiry[key] = (value, now + expires_in)
+
+
+def _legacy_expires_in(expired_time):
+    """seconds left of a credential written by a release before 0.1.4, None if unknown.
+
+    those keep the value without ttl and its expiry in <key>:expired_time.
+    """
+    if not expired_time:
+        return None
+    try:
+        expired_at = datetime.strptime(expired_time, legacy_datetime_format)
+    except ValueError:
+        return None
+    return (expired_at - datetime.utcnow()).total_seconds()
+
+
+def _expires_in(value, pttl, expired_time):
+    """seconds a cached credential is still valid, None on a miss."""
+    if value is None or pttl is None or pttl == -2:
+        return None
+    if pttl == -1:
+        expires_in = _legacy_expires_in(expired_time)
+    else:
+        expires_in = pttl / 1000.0
+    if expires_in is None or expires_in <= 0:
+        return None
+    return expires_in
+
+
+def _pipe_credential(pipe, key):
+    pipe.get(key)
+    pipe.pttl(key)
+    pipe.get(key + ':expired_time')
+
+
+def _load_credentials(*keys):
+    """read credentials from L1, and the misses from redis in one round trip."""
+    values = [credential_cache.get(k) for k in keys]
+    missed = [k for k, v in zip(keys, values) if v is None]
+    if not missed:
+        return values
+
+    pipe = db.pipeline(transaction=False)
+    for k in missed:
+        _pipe_credential(pipe, k)
+    res = pipe.execute()
+
+    loaded = {}
+    for i, k in enumerate(missed):
+        value = res[3 * i]
+        expires_in = _expires_in(value, res[3 * i + 1], res[3 * i + 2])
+        if expires_in is None:
+            continue
+        _cache_locally(k, value, expires_in)
+        loaded[k] = value
+    return [v if v is not None else loaded.get(k) for k, v in zip(keys, values)]
+
+
+def _cached_credential(key):
+    """(value, seconds it is still valid) from redis, (None, None) on a miss."""
+    pipe = db.pipeline(transaction=False)
+    _pipe_credential(pipe, key)
+    value, pttl, expired_time = pipe.execute()
+    expires_in = _expires_in(value, pttl, expired_time)
+    if expires_in is None:
+        return None, None
+    return value, expires_in
+
+
+def credential_expires_in(key):
+    """seconds the credential cached under key is still valid, 0 if there is none."""
+    return _cached_credential(key)[1] or 0
+
+
+def _fresh_credential(key, min_ttl):
+    """cached credential only if it still has more than min_ttl seconds to live."""
+    value, expires_in = _cached_credential(key)
+    if expires_in is None or expires_in <= min_ttl:
+        return None
+    return value
+
+
+def _save_credential(key, value, expires_in):
+    # expire a minute early so a cached credential is never rejected by weixin
+    expires_in -= 60
+    # processes still on a release before 0.1.4 read <key>:expired_time right
+    # after the value, so it outlives the value and is never missing next to it
+    expired_time = (datetime.utcnow() + timedelta(seconds=expires_in)).strftime(legacy_datetime_format)
+    pipe = db.pipeline(transaction=False)
+    pipe.setex(key, expires_in, value)
+    pipe.setex(key + ':expired_time', expires_in + 60, expired_time)
+    pipe.execute()
+    _cache_locally(key, value, expires_in)
 
 
 class WxTkApiErr(Exception):
@@ -41,19 +237,74 @@ class WxTkApi(object):
         else:
             self.app_secret = settings.WX_APP_SECRET
 
-    def get_access_token(self):
-        cached_access_token = db.get('wx:access_token')
+        # the default app keeps the original global keys
+        if self.app_id == settings.WX_APP_ID:
+            key_prefix = 'wx:'
+        else:
+            key_prefix = 'wx:%s:' % self.app_id
+        self.access_token_key = key_prefix + 'access_token'
+        self.jsapi_ticket_key = key_prefix + 'jsapi_ticket'
 
-        if cached_access_token is None:
-            return self._get_wx_token()
+    def _request(self, method, url, **kwargs):
+        if not wx_breaker.allow():
+            raise WxTkApiErr('circuit open', None)
 
-        expired_time = db.get('wx:access_token:expired_time')
-        expired_time = datetime.strptime(expired_time, datetime_format)
+        metrics.incr('wechat')
+        kwargs.setdefault('timeout', (http_connect_timeout, http_read_timeout))
+        try:
+            r = get_session().request(method, url, **kwargs)
+        except Exception:
+            # whatever went wrong, a half open breaker must hear back from its probe
+            wx_breaker.record_failure()
+            raise
 
-        if datetime.utcnow() < expired_time:
-            return cached_access_token
+        if r.status_code >= 500:
+            wx_breaker.record_failure()
         else:
-            return self._get_wx_token()
+            wx_breaker.record_success()
+        return r
+
+    def _get(self, url, **kwargs):
+        return self._request('GET', url, **kwargs)
+
+    def _post(self, url, **kwargs):
+        return self._request('POST', url, **kwargs)
+
+    def _refresh_once(self, lock_key, get_cached, refresh):
+        """single-flight refresh shared by all workers.
+
+        only the holder of `lock_key` calls weixin, everybody else polls the
+        cache until the holder publishes the new value or gives up the lock.
+        """
+        lock_token = uuid.uuid4().hex
+        deadline = time.time() + token_wait_timeout
+        while True:
+            if db.set(lock_key, lock_token, ex=token_lock_timeout, nx=True):
+                try:
+                    # someone may have published between our miss and the lock
+                    value = get_cached()
+                    if value is None:
+                        value = refresh()
+                    return value
+                finally:
+                    release_lock_script(keys=[lock_key], args=[lock_token])
+
+            if time.time() >= deadline:
+                raise WxTkApiErr('timeout', None)
+            time.sleep(token_wait_interval)
+            value = get_cached()
+            if value is not None:
+                return value
+
+    def _cached_access_token(self):
+        return _load_credentials(self.access_token_key)[0]
+
+    def get_access_token(self):
+        access_token = self._cached_access_token()
+        if access_token is not None:
+            return access_token
+
+        return self._refresh_once(self.access_token_key + ':lock', self._cached_access_token, self._get_wx_token)
 
     def _get_wx_token(self):
         url = WxTkApi.API_DOMAIN + ('/cgi-bin/token')
@@ -63,8 +314,10 @@ class WxTkApi(object):
             'secret': self.app_secret,
         }
         try:
-            r = requests.get(url, params=payload, timeout=4)
+            r = self._get(url, params=payload)
             res = r.json()
+        except WxTkApiErr:
+            raise
         except requests.exceptions.Timeout:
             raise WxTkApiErr('timeout', None)
         except Exception:
@@ -73,27 +326,20 @@ class WxTkApi(object):
         if not 'access_token' in res:
             raise WxTkApiErr('error', r.text)
 
-        now = timezone.now()
-        expired_time = now + timedelta(seconds=res['expires_in'] - 60)
-        expired_time = expired_time.strftime(datetime_format)
-        db.set('wx:access_token', res['access_token'])
-        db.set('wx:access_token:expired_time', expired_time)
+        _save_credential(self.access_token_key, res['access_token'], res['expires_in'])
 
         return res['access_token']
 
-    def get_jsapi_ticket(self, access_token):
-        cached_jsapi_ticket = db.get('wx:jsapi_ticket')
+    def _cached_jsapi_ticket(self):
+        return _load_credentials(self.jsapi_ticket_key)[0]
 
-        if cached_jsapi_ticket is None:
-            return self._get_jsapi_ticket(access_token)
+    def get_jsapi_ticket(self, access_token):
+        jsapi_ticket = self._cached_jsapi_ticket()
+        if jsapi_ticket is not None:
+            return jsapi_ticket
 
-        expired_time = db.get('wx:jsapi_ticket:expired_time')
-        expired_time = datetime.strptime(expired_time, datetime_format)
-
-        if datetime.utcnow() < expired_time:
-            return cached_jsapi_ticket
-        else:
-            return self._get_jsapi_ticket(access_token)
+        return self._refresh_once(
+            self.jsapi_ticket_key + ':lock', self._cached_jsapi_ticket, lambda: self._get_jsapi_ticket(access_token))
 
     def _get_jsapi_ticket(self, access_token):
         url = WxTkApi.API_DOMAIN + ('/cgi-bin/ticket/getticket')
@@ -103,8 +349,10 @@ class WxTkApi(object):
         }
 
         try:
-            r = requests.get(url, params=payload, timeout=4)
+            r = self._get(url, params=payload)
             res = r.json()
+        except WxTkApiErr:
+            raise
         except requests.exceptions.Timeout:
             raise WxTkApiErr('timeout', None)
         except Exception as e:
@@ -114,16 +362,33 @@ class WxTkApi(object):
         if not 'ticket' in res:
             raise WxTkApiErr('error', r.text)
 
-        now = timezone.now()
-        expired_time = now + timedelta(seconds=res['expires_in'] - 60)
-        expired_time = expired_time.strftime(datetime_format)
-        db.set('wx:jsapi_ticket', res['ticket'])
-        db.set('wx:jsapi_ticket:expired_time', expired_time)
+        _save_credential(self.jsapi_ticket_key, res['ticket'], res['expires_in'])
 
         return res['ticket']
 
+    def refresh_credentials(self, min_ttl):
+        """renew access_token and jsapi_ticket that have less than min_ttl seconds left.
+
+        the cached values keep being served until the renewed ones are saved.
+        """
+        access_token = self._refresh_once(
+            self.access_token_key + ':lock', lambda: _fresh_credential(self.access_token_key, min_ttl),
+            self._get_wx_token)
+        self._refresh_once(
+            self.jsapi_ticket_key + ':lock', lambda: _fresh_credential(self.jsapi_ticket_key, min_ttl),
+            lambda: self._get_jsapi_ticket(access_token))
+
+    def get_jsapi_credentials(self):
+        """access_token and jsapi_ticket for signing, one redis round trip when both are cached."""
+        access_token, jsapi_ticket = _load_credentials(self.access_token_key, self.jsapi_ticket_key)
+        if access_token is None:
+            access_token = self.get_access_token()
+        if jsapi_ticket is None:
+            jsapi_ticket = self.get_jsapi_ticket(access_token)
+        return access_token, jsapi_ticket
+
     def get_jsapi_sign(self, jsapi_ticket, url):
-        nonce_str = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(15))
+        nonce_str = binascii.hexlify(os.urandom(8))[:15]
         timestamp = int(time.time())
 
         ret = {
@@ -139,7 +404,8 @@ class WxTkApi(object):
         del ret['jsapi_ticket']
         return ret
 
-    def get_media(self, access_token, media_id):
+    def _open_media(self, access_token, media_id):
+        """start downloading a media, the body is left unread on the returned response."""
         url = 'http://file.api.weixin.qq.com/cgi-bin/media/get'
         payload = {
             'access_token': access_token,
@@ -147,19 +413,71 @@ class WxTkApi(object):
         }
 
         try:
-            r = requests.get(url, params=payload, timeout=4)
+            r = self._get(url, params=payload, stream=True)
+        except WxTkApiErr:
+            raise
         except requests.exceptions.Timeout:
             raise WxTkApiErr('timeout', None)
         except Exception:
             raise WxTkApiErr('unknown', None)
 
         if int(r.status_code) != 200:
+            r.close()
             raise WxTkApiErr('http error code %s' % r.status_code, None)
-        elif 'errcode' in r.text:
-            res_json = json.loads(r.text)
-            raise WxTkApiErr(res_json, None)
 
-        return r.content
+        # media comes with its own content type, only errors are sent as json or text
+        content_type = r.headers.get('Content-Type', '')
+        if content_type.startswith(('application/json', 'text/')):
+            text = r.text
+            if 'errcode' in text:
+                raise WxTkApiErr(json.loads(text), None)
+        return r
+
+    def get_cached_jsapi_sign(self, jsapi_ticket, url):
+        """get_jsapi_sign, reused for the same ticket and url until the ticket expires in redis."""
+        url = _normalize_sign_url(url)
+        key = (jsapi_ticket, url)
+        ret = jsapi_sign_cache.get(key)
+        if ret is None:
+            ret = self.get_jsapi_sign(jsapi_ticket, url)
+            ticket, expired_at = credential_expiry.get(self.jsapi_ticket_key, (None, None))
+            if ticket != jsapi_ticket:
+                # a ticket this process did not load, its lifetime is unknown
+                expired_at = time.time() + local_cache_ttl
+            jsapi_sign_cache.set(key, ret, expired_at)
+        # callers add appId to what they get
+        return dict(ret)
+
+    def get_media(self, access_token, media_id):
+        return self._open_media(access_token, media_id).content
+
+    def iter_media(self, access_token, media_id, chunk_size=media_chunk_size):
+        """media content in chunks of chunk_size bytes, memory stays flat whatever its size.
+
+        weixin errors are raised here, before the first chunk is read.
+        """
+        r = self._open_media(access_token, media_id)
+
+        def iter_content():
+            try:
+                for chunk in r.iter_content(chunk_size):
+                    yield chunk
+            except requests.exceptions.RequestException:
+                raise WxTkApiErr('unknown', None)
+            finally:
+                r.close()
+        return iter_content()
+
+    def save_media(self, access_token, media_id, dest, chunk_size=media_chunk_size):
+        """stream media into dest, a file path or a writable file-like object.
+
+        :return: number of bytes written
+        """
+        chunks = self.iter_media(access_token, media_id, chunk_size)
+        if isinstance(dest, basestring):
+            with open(dest, 'wb') as f:
+                return _write_chunks(f, chunks)
+        return _write_chunks(dest, chunks)
 
     def get_auth_url(self, redirect_url, scope='snsapi_base', state='STATE'):
         auth_url = 'https://open.weixin.qq.com/connect/oauth2/authorize?' + urlencode([
@@ -178,8 +496,10 @@ class WxTkApi(object):
         url = 'https://api.weixin.qq.com/sns/oauth2/refresh_token?appid=%s&grant_type=refresh_token&refresh_token=%s'
         url = url % (self.app_id, refresh_token)
         try:
-            r = requests.get(url)
+            r = self._get(url)
             res = r.json()
+        except WxTkApiErr:
+            raise
         except Exception as e:
             exception_logger.error(e)
             raise WxTkApiErr('error', r.text)
@@ -203,9 +523,11 @@ class WxTkApi(object):
         url = WxTkApi.API_DOMAIN + '/sns/oauth2/access_token?' + 'appid=' + self.app_id + '&secret=' + self.app_secret + '&code=' + code + '&grant_type=authorization_code'
 
         try:
-            r = requests.get(url, timeout=4)
+            r = self._get(url)
             info_logger.info("%s%s" % (code, r.content))
             res = r.json()
+        except WxTkApiErr:
+            raise
         except requests.exceptions.Timeout:
             raise WxTkApiErr('timeout', None)
         except Exception:
@@ -244,8 +566,10 @@ class WxTkApi(object):
         }
 
         try:
-            r = requests.get(url, params=payload, timeout=4)
+            r = self._get(url, params=payload)
             res = r.json()
+        except WxTkApiErr:
+            raise
         except requests.exceptions.Timeout:
             raise WxTkApiErr('timeout', None)
         except Exception:
@@ -283,8 +607,10 @@ class WxTkApi(object):
         }
 
         try:
-            r = requests.get(url, params=payload, timeout=4)
+            r = self._get(url, params=payload)
             res = r.json()
+        except WxTkApiErr:
+            raise
         except requests.exceptions.Timeout:
             raise WxTkApiErr('timeout', None)
         except Exception:
@@ -292,28 +618,108 @@ class WxTkApi(object):
 
         return res
 
+    def batch_get_user_info(self, access_token, openids):
+        """user info of at most user_info_batch_size openids in one call, fields as in get_user_info."""
+        url = WxTkApi.API_DOMAIN + '/cgi-bin/user/info/batchget'
+        payload = {
+            'user_list': [{'openid': openid, 'lang': 'zh_CN'} for openid in openids],
+        }
+
+        try:
+            r = self._post(url, params={'access_token': access_token}, data=json.dumps(payload))
+            res = r.json()
+        except WxTkApiErr:
+            raise
+        except requests.exceptions.Timeout:
+            raise WxTkApiErr('timeout', None)
+        except Exception:
+            raise WxTkApiErr('unknown', None)
+
+        if 'user_info_list' not in res:
+            error_logger.error(u'batch_get_user_info 报错 %s', r.text)
+            raise WxTkApiErr('error', r.text)
+
+        return res['user_info_list']
+
+    def iter_user_info(self, access_token, openids, concurrency=4):
+        """user info of any number of openids.
 
-def get_wechat_sdk(absolute_url):
+        openids are sent in batches of user_info_batch_size, at most `concurrency`
+        batches in flight; users are yielded as their batch arrives, not in input order.
+        """
+        openids = iter(openids)
+        batches = iter(lambda: list(islice(openids, user_info_batch_size)), [])
+
+        pool = ThreadPool(concurrency)
+        try:
+            for user_info_list in pool.imap_unordered(lambda b: self.batch_get_user_info(access_token, b), batches):
+                for user_info in user_info_list:
+                    yield user_info
+        finally:
+            pool.terminate()
+
+
+_apis = {}
+
+
+def get_wx_api(app_id=None):
+    """shared WxTkApi of a registered app, settings.WX_APP_ID by default.
+
+    every app keeps its own tokens and tickets, all of them share the http
+    pool and the credential refresher. WxTkApi keeps no per request state.
+    """
+    app_id = app_id or settings.WX_APP_ID
+    api = _apis.get(app_id)
+    if api is None:
+        if app_id == settings.WX_APP_ID:
+            app_secret = settings.WX_APP_SECRET
+        else:
+            app_secret = wx_apps[app_id]
+        api = _apis.setdefault(app_id, WxTkApi(app_id, app_secret))
+    return api
+
+
+def register_app(app_id, app_secret):
+    """serve one more official account besides those in settings.WX_APPS."""
+    wx_apps[app_id] = app_secret
+    _apis.pop(app_id, None)
+
+
+def get_registered_app_ids():
+    return [settings.WX_APP_ID] + [app_id for app_id in wx_apps if app_id != settings.WX_APP_ID]
+
+
+def empty_wechat_sdk():
+    """what pages get when weixin can not be signed for."""
+    return {
+        'wechat_sdk': {
+            'nonceStr': '',
+            'jsapi_ticket': '',
+            'timestamp': '',
+            'url': '',
+            'appId': ''
+        }
+    }
+
+
+def get_wechat_sdk(absolute_url, app_id=None):
     """
     Get wechat sdk data pack.
     :param absolute_url:
+    :param app_id: registered app to sign for, settings.WX_APP_ID by default
     :return:
     """
     wechat_sdk = {}
     try:
-        wxapi = WxTkApi()
-        access_token = wxapi.get_access_token()
-        jsapi_ticket = wxapi.get_jsapi_ticket(access_token)
-        wxconfig = wxapi.get_jsapi_sign(jsapi_ticket, absolute_url)
+        wxapi = get_wx_api(app_id)
+        access_token, jsapi_ticket = wxapi.get_jsapi_credentials()
+        if jsapi_sign_cache_enabled:
+            wxconfig = wxapi.get_cached_jsapi_sign(jsapi_ticket, absolute_url)
+        else:
+            wxconfig = wxapi.get_jsapi_sign(jsapi_ticket, absolute_url)
         wechat_sdk['wechat_sdk'] = wxconfig
-        wechat_sdk['wechat_sdk']['appId'] = settings.WX_APP_ID
+        wechat_sdk['wechat_sdk']['appId'] = wxapi.app_id
     except Exception as e:
         error_logger.error(u'取微信签名报错 %s', e.message)
-        wechat_sdk['wechat_sdk'] = {
-            'nonceStr': '',
-            'jsapi_ticket': '',
-            'timestamp': '',
-            'url': '',
-            'appId': ''
-        }
+        wechat_sdk = empty_wechat_sdk()
     return wechat_sdk
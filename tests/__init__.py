@@ -0,0 +1,67 @@
+# coding=utf-8
+"""tests of gm_share, run them from the repository root:
+
+    python -m unittest discover -s tests -t .
+
+helios, gm-logging and gm-types must be installed, redis is replaced by
+fakeredis, so no redis server is needed.
+"""
+import logging
+import os
+import sys
+import types
+
+import django
+import fakeredis
+import redis
+from django.conf import settings
+
+settings.configure(
+    DEBUG=False,
+    USE_TZ=True,
+    ALLOWED_HOSTS=['*'],
+    ROOT_URLCONF='tests.urls',
+    TEMPLATE_DIRS=[os.path.join(os.path.dirname(__file__), 'templates')],
+    REDIS_CONFIG={'host': 'localhost', 'port': 6379, 'db': 0},
+    WX_APP_ID='wx-test-app',
+    WX_APP_SECRET='wx-test-secret',
+    WEIBO_SHARE_HOST='http://t.cn/share',
+    TDK={},
+    VIEW_METRICS_SINK=None,
+)
+django.setup()
+# expected errors, e.g. of timeouts, are logged by the code under test
+logging.basicConfig(level=logging.CRITICAL)
+
+# the project using gm_share provides gm_share.settings
+sys.modules.setdefault('gm_share.settings', types.ModuleType('gm_share.settings')).settings = settings
+
+
+class InMemoryRedis(fakeredis.FakeStrictRedis):
+    """redis.StrictRedis on fakeredis, every client sees the same data."""
+
+    def __init__(self, *args, **kwargs):
+        super(InMemoryRedis, self).__init__()
+
+    def register_script(self, script):
+        def run(keys=(), args=(), client=None):
+            return self.eval(script, len(keys), *(list(keys) + list(args)))
+        return run
+
+
+redis.StrictRedis = InMemoryRedis
+
+from gm_share.commons.common import Config
+from gm_share.libs import redis_db
+
+# _CountingRedis.pipeline builds a real StrictPipeline on the connection pool
+redis_db.db.pipeline = lambda transaction=True, shard_hint=None: fakeredis.FakePipeline(redis_db.db, transaction)
+
+# set by the project as well
+Config.session_cookie_name = 'sessionid'
+Config.channel_cookie_name = 'channel'
+Config.url_base = '/'
+
+
+def flush_redis():
+    redis_db.db.flushall()
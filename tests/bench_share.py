@@ -0,0 +1,93 @@
+# coding=utf-8
+"""strip_markdown_links on adversarial inputs, the scanners against the old patterns.
+
+    python -m tests.bench_share
+
+every input is built at three sizes, n, 4n and 16n characters' worth of
+repetitions. the patterns backtrack on several of them, so they only run at
+the smallest size. exits with 1 when the scanners give another result than
+the patterns, or when their time grows more than max_growth times from n to
+16n (linear is 16, quadratic 256).
+
+the common case is tests/data/posts.txt, every post stripped on its own as
+share texts are, as written and with their links already gone. exits with 1
+too when the scanners take more than max_slowdown times what the patterns
+take on them.
+"""
+import sys
+import time
+
+from tests.test_share import load_posts, strip_with_patterns
+
+from gm_share.share import strip_markdown_links
+
+
+max_growth = 40
+max_slowdown = 2.0
+
+adversarial = [
+    # name, repeated unit, prefix, suffix, repetitions at the smallest size
+    ('unbalanced ]', u'a]', u'[', u'](x', 1000),
+    ('many [ without ]', u'[', u'', u'', 2000),
+    (']( without )', u'[a](', u'', u'', 500),
+    ('<iframe without close', u'<iframe', u'', u'', 1000),
+    ('gengmei:// without )', u'[](gengmei://', u'', u'', 100),
+    ('title without close', u'"', u'[a](x ', u')', 1000),
+    ('nested brackets', u'[[a]', u'', u'](x)', 1000),
+]
+
+
+def per_call(func, text):
+    """best time of one call in seconds, every sample runs for at least 20ms."""
+    loops = 1
+    while True:
+        started = time.time()
+        for _ in range(loops):
+            func(text)
+        elapsed = time.time() - started
+        if elapsed >= 0.02:
+            break
+        loops *= 4
+    best = elapsed / loops
+    for _ in range(2):
+        started = time.time()
+        for _ in range(loops):
+            func(text)
+        best = min(best, (time.time() - started) / loops)
+    return best
+
+
+def main():
+    failures = []
+    print('%-24s %8s %12s %12s %12s %12s %7s' % (
+        'input', 'chars', 'patterns', 'scanner', 'scanner 4n', 'scanner 16n', 'growth'))
+    for name, unit, prefix, suffix, n in adversarial:
+        texts = [prefix + unit * (n * k) + suffix for k in (1, 4, 16)]
+        if strip_markdown_links(texts[0]) != strip_with_patterns(texts[0]):
+            failures.append('%s: scanners differ from the patterns' % name)
+        patterns = per_call(strip_with_patterns, texts[0])
+        scanner = [per_call(strip_markdown_links, text) for text in texts]
+        growth = scanner[2] / scanner[0]
+        print('%-24s %8d %10.3fms %10.3fms %10.3fms %10.3fms %7.1f' % (
+            name, len(texts[0]), patterns * 1e3, scanner[0] * 1e3, scanner[1] * 1e3, scanner[2] * 1e3, growth))
+        if growth > max_growth:
+            failures.append('%s: 16 times the input takes %.0f times as long' % (name, growth))
+
+    posts = load_posts()
+    print('')
+    print('%-24s %8s %12s %12s %9s' % ('common case', 'chars', 'patterns', 'scanner', 'slowdown'))
+    for name, texts in [('posts', posts), ('posts without links', [strip_with_patterns(post) for post in posts])]:
+        patterns = per_call(lambda texts: [strip_with_patterns(text) for text in texts], texts)
+        scanner = per_call(lambda texts: [strip_markdown_links(text) for text in texts], texts)
+        print('%-24s %8d %10.3fms %10.3fms %9.2f' % (
+            name, sum(len(text) for text in texts), patterns * 1e3, scanner * 1e3, scanner / patterns))
+        if scanner > patterns * max_slowdown:
+            failures.append('%s: %.2f times as long as the patterns' % (name, scanner / patterns))
+
+    for failure in failures:
+        print('FAIL ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
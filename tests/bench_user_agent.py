@@ -0,0 +1,52 @@
+# coding=utf-8
+"""micro-benchmark of classify_user_agent against the regexes CommonView ran before.
+
+    python -m tests.bench_user_agent
+
+traffic is replayed from tests/data/user_agents.tsv, weighted towards weixin
+the way share pages are visited. exits with 1 when the cached classifier is
+not at least min_speedup times faster than the old regexes.
+"""
+import sys
+import timeit
+
+from tests.test_user_agent import get_client_and_platform, load_user_agents
+
+from gm_share.commons.user_agent import _classified, _classify, classify_user_agent
+
+
+min_speedup = 2.0
+repeat = 5
+
+
+def traffic():
+    user_agents = [ua for ua, _ in load_user_agents()]
+    weixin = [ua for ua in user_agents if 'MicroMessenger' in ua]
+    return weixin * 20 + user_agents * 2
+
+
+def per_call(func, user_agents):
+    """best of repeat runs, microseconds per user agent."""
+    seconds = min(timeit.repeat(lambda: [func(ua) for ua in user_agents], number=20, repeat=repeat))
+    return seconds / 20 / len(user_agents) * 1e6
+
+
+def main():
+    user_agents = traffic()
+    _classified.clear()
+    results = [
+        ('old regexes', per_call(get_client_and_platform, user_agents)),
+        ('classify, uncached', per_call(_classify, user_agents)),
+        ('classify_user_agent', per_call(classify_user_agent, user_agents)),
+    ]
+    print('%d user agents, %d distinct' % (len(user_agents), len(set(user_agents))))
+    for name, us in results:
+        print('%-22s %6.2f us' % (name, us))
+
+    speedup = results[0][1] / results[2][1]
+    print('speedup %.1fx, at least %.1fx expected' % (speedup, min_speedup))
+    return 0 if speedup >= min_speedup else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+# coding=utf-8
+"""overhead the view framework of gm_share.weixin.views.base adds to a request.
+
+    python -m tests.bench_views           # compare with tests/data/bench_views.json
+    python -m tests.bench_views --save    # record this machine's numbers as the baseline
+
+a JsonView, a TemplateView and an AuthenticatedJsonView are run through
+django's RequestFactory, redis is fakeredis and rpc a stub answering at once,
+so what is measured is the pipeline itself: Context, stage dispatch,
+stage_pre (user agent, rpc invoker), stage_decorate and rendering.
+
+per view it reports requests per second, the mean time of every stage and
+the gc objects a request allocates and does not free before it returns, which
+the cyclic gc then has to collect (python 2 has no tracemalloc). exits with 1
+when any of them is past the baseline: time by more than --tolerance times,
+gc objects by more than max_extra_objects.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+from django.test import RequestFactory
+
+from tests import flush_redis
+from tests.stubs import StubInvoker
+
+from gm_share.libs import metrics, session_user
+from gm_share.weixin.views import base
+from gm_share.weixin.views.base import AuthenticatedJsonView, FetchTask, JsonView, TemplateView
+
+
+baseline_path = os.path.join(os.path.dirname(__file__), 'data', 'bench_views.json')
+# stages take microseconds, differences below this are noise
+min_stage_delta_ms = 0.05
+max_extra_objects = 5
+
+user_agent = ('Mozilla/5.0 (iPhone; CPU iPhone OS 11_2_6 like Mac OS X) AppleWebKit/604.5.6 '
+              '(KHTML, like Gecko) Mobile/15D100 MicroMessenger/6.6.5 NetType/4G Language/zh_CN')
+
+diary = {
+    'id': 1,
+    'title': u'双眼皮术后第30天',
+    'content': u'恢复得不错' * 40,
+    'images': ['http://pic.gmei.com/diary/%d.jpg' % i for i in range(9)],
+    'tags': [{'id': i, 'name': u'双眼皮'} for i in range(5)],
+}
+
+
+class DiaryJsonView(JsonView):
+    url_name = 'bench_diary_json'
+    fetch_tasks = {
+        'diary': FetchTask('fetch_diary'),
+    }
+
+    def fetch_diary(self, ctx):
+        return ctx.rpc['api/diary/get'](diary_id=1).unwrap()
+
+    def stage_transform(self, ctx):
+        diary = ctx.fetch['diary']
+        return {
+            'diary': diary,
+            'platform': ctx.platform,
+            'from_client': ctx.from_client,
+            'has_login': ctx.has_login,
+        }
+
+
+class DiaryTemplateView(TemplateView):
+    url_name = 'bench_diary_page'
+    template = 'page.html'
+
+    def stage_fetch(self, ctx):
+        return {'diary': ctx.rpc['api/diary/get'](diary_id=1).unwrap()}
+
+    def stage_transform(self, ctx):
+        return {'items': [ctx.fetch['diary']] * 10, 'tdk': {'title': ctx.fetch['diary']['title']}}
+
+
+class UserJsonView(AuthenticatedJsonView):
+    url_name = 'bench_user_json'
+
+    def stage_transform(self, ctx):
+        return {'user': ctx.rpc['api/user_info']().unwrap(), 'session': ctx.session_key}
+
+
+views = (DiaryJsonView, DiaryTemplateView, UserJsonView)
+
+
+def make_request(path):
+    request = RequestFactory().get(path, HTTP_USER_AGENT=user_agent)
+    request.COOKIES['sessionid'] = 'bench-session'
+    return request
+
+
+def gc_objects(view, request, n):
+    """gc objects n requests leave behind for the cyclic gc, per request."""
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in range(n):
+            view(request)
+        return float(gc.get_count()[0] - before) / n
+    finally:
+        gc.enable()
+
+
+def run(view_class, n):
+    view = view_class()
+    request = make_request('/bench/%s' % view_class.url_name)
+    for _ in range(n // 10):
+        response = view(request)
+        assert response.status_code == 200, response.status_code
+
+    sink = metrics.get_sink()
+    sink.clear()
+    started = time.time()
+    for _ in range(n):
+        view(request)
+    elapsed = time.time() - started
+
+    stats = sink.snapshot()[view_class.url_name]
+    stages = dict((stage, s['mean'] * 1000) for stage, s in stats.items() if stage not in ('calls', 'total'))
+    return {
+        'rps': round(n / elapsed),
+        'total_ms': round(stats['total']['mean'] * 1000, 4),
+        'stages_ms': dict((stage, round(ms, 4)) for stage, ms in stages.items()),
+        # small n is enough, it only counts
+        'gc_objects': round(gc_objects(view, request, 200), 1),
+    }
+
+
+def compare(name, result, baseline, tolerance):
+    """what regressed past the thresholds, as messages."""
+    failures = []
+    if result['rps'] * tolerance < baseline['rps']:
+        failures.append('%s: %.0f req/s, baseline %.0f' % (name, result['rps'], baseline['rps']))
+    for stage, ms in sorted(result['stages_ms'].items()):
+        base_ms = baseline['stages_ms'].get(stage)
+        if base_ms is not None and ms > base_ms * tolerance and ms - base_ms > min_stage_delta_ms:
+            failures.append('%s: stage %s %.3fms, baseline %.3fms' % (name, stage, ms, base_ms))
+    if result['gc_objects'] > baseline['gc_objects'] + max_extra_objects:
+        failures.append('%s: %.1f gc objects a request, baseline %.1f' % (
+            name, result['gc_objects'], baseline['gc_objects']))
+    return failures
+
+
+def report(name, result):
+    print('%s: %.0f req/s, %.3fms a request, %.1f gc objects a request' % (
+        name, result['rps'], result['total_ms'], result['gc_objects']))
+    for stage, ms in sorted(result['stages_ms'].items(), key=lambda item: -item[1]):
+        print('    %-10s %.3fms' % (stage, ms))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark of the view pipeline')
+    parser.add_argument('-n', type=int, default=2000, help='requests per view')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='how many times slower fails')
+    parser.add_argument('--save', action='store_true', help='record the results as the baseline')
+    args = parser.parse_args(argv)
+
+    flush_redis()
+    session_user.set_user_id('bench-session', 1)
+    invoker = StubInvoker({
+        'api/diary/get': lambda diary_id: diary,
+        'api/user_info': lambda: {'user_id': 1, 'nickname': u'更美'},
+    })
+    base.get_base_rpc_invoker = lambda: invoker
+    metrics._sink = metrics.MemorySink()
+
+    results = {}
+    for view_class in views:
+        results[view_class.__name__] = result = run(view_class, args.n)
+        report(view_class.__name__, result)
+        # stub calls are not of interest, keep memory flat
+        del invoker.calls[:]
+
+    if args.save:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        print('baseline saved to %s' % baseline_path)
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print('no baseline, record one with --save')
+        return 0
+    with open(baseline_path) as f:
+        baselines = json.load(f)
+    failures = []
+    for name, result in sorted(results.items()):
+        if name in baselines:
+            failures.extend(compare(name, result, baselines[name], args.tolerance))
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
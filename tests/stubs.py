@@ -0,0 +1,60 @@
+# coding=utf-8
+import time
+
+from redis import ConnectionError
+
+
+class StubRPCResult(object):
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def unwrap(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StubInvoker(object):
+    """helios invoker answering from handlers, {method: func(**params)}."""
+
+    def __init__(self, handlers=None, delay=0):
+        self.handlers = handlers or {}
+        self.delay = delay
+        self.calls = []
+
+    def with_config(self, **config):
+        return self
+
+    def __getitem__(self, method):
+        def call(**params):
+            self.calls.append((method, params))
+            if self.delay:
+                time.sleep(self.delay)
+            # like helios, errors are raised when the result is unwrapped
+            try:
+                return StubRPCResult(self.handlers[method](**params))
+            except Exception as e:
+                return StubRPCResult(error=e)
+        return call
+
+
+class DownRedis(object):
+    """redis whose server is away: every command fails, a pipeline when it is executed."""
+
+    def fail(self, *args, **kwargs):
+        raise ConnectionError('Error 111 connecting to localhost:6379. Connection refused.')
+
+    def __getattr__(self, name):
+        return self.fail
+
+    def pipeline(self, transaction=True):
+        return DownPipeline(self)
+
+
+class DownPipeline(object):
+    def __init__(self, redis):
+        self.execute = redis.fail
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
@@ -0,0 +1,175 @@
+# coding=utf-8
+import os
+import random
+import unittest
+
+from django.utils.translation import ugettext_lazy
+
+from tests import flush_redis
+from tests.stubs import DownRedis
+
+from gm_share import share
+from gm_share.commons.common import Config
+from gm_share.libs.redis_db import db
+
+
+def load_posts():
+    path = os.path.join(os.path.dirname(__file__), 'data', 'posts.txt')
+    with open(path) as f:
+        text = f.read().decode('utf-8')
+    # the first line describes the file
+    text = text.split(u'\n', 1)[1]
+    return [post for post in text.split(u'\n%%\n') if post.strip()]
+
+
+def strip_with_patterns(md_txt, keep_image=False):
+    """strip_markdown_links as it was before the scanners, by the retained patterns."""
+    striped = share._link.sub('', md_txt)
+    if keep_image:
+        return striped
+
+    striped = share._image_link.sub('', striped)
+    striped = share._iframe.sub('', striped)
+    striped = share.gengmei_link.sub('', striped)
+    return striped
+
+
+# every character the patterns care about, and runs of them
+tokens = ['[', ']', '(', ')', '!', '^', '<', '>', ' ', '\n', '\t', '"', "'", 'a', 'b', u'更',
+          '](', '](gengmei://', 'gengmei://', '<iframe', '</iframe>']
+
+
+def random_markdown(rnd, max_tokens):
+    # skewed towards the first tokens, so brackets cluster the way they do when they go wrong
+    return u''.join(
+        rnd.choice(tokens) if rnd.random() < 0.5 else tokens[int(rnd.random() ** 2 * len(tokens))]
+        for _ in range(rnd.randint(0, max_tokens)))
+
+
+class StripMarkdownLinksTest(unittest.TestCase):
+    def assertSameAsPatterns(self, text):
+        self.assertEqual(share._strip_links(text, False), share._link.sub('', text), text)
+        self.assertEqual(share._strip_links(text, True), share._image_link.sub('', text), text)
+        self.assertEqual(share._strip_iframes(text), share._iframe.sub('', text), text)
+        self.assertEqual(share._strip_gengmei_links(text), share.gengmei_link.sub('', text), text)
+        self.assertEqual(share.strip_markdown_links(text), strip_with_patterns(text), text)
+        self.assertEqual(share.strip_markdown_links(text, True), strip_with_patterns(text, True), text)
+
+    def test_posts(self):
+        for post in load_posts():
+            self.assertSameAsPatterns(post)
+
+    def test_examples(self):
+        self.assertEqual(share.strip_markdown_links(u'a [b](http://c "d") e'), u'a  e')
+        self.assertEqual(share.strip_markdown_links(u'a ![b](<http://c>) e'), u'a  e')
+        self.assertEqual(share.strip_markdown_links(u'a ![b](http://c) e', keep_image=True), u'a ![b](http://c) e')
+        self.assertEqual(share.strip_markdown_links(u'[[b]](x) [a]b] c'), u' [a]b] c')
+        self.assertEqual(share.strip_markdown_links(u'a<iframe src="x"></iframe>b'), u'ab')
+        self.assertEqual(share.strip_markdown_links(u'a [b](gengmei://c) d'), u'a  d')
+
+    def test_random_markdown(self):
+        rnd = random.Random(22)
+        for _ in range(20000):
+            self.assertSameAsPatterns(random_markdown(rnd, 25))
+
+    def test_heads(self):
+        # what the scanners return for the head of a text stays in the result of the whole text
+        rnd = random.Random(2023)
+        for _ in range(5000):
+            text = random_markdown(rnd, 40)
+            head = text[:rnd.randint(0, len(text))]
+            for keep_image in (False, True):
+                stripped = share.strip_markdown_links(text, keep_image)
+                self.assertTrue(stripped.startswith(share._strip_markdown(head, keep_image, False)), (text, head))
+
+    def test_long_random_markdown(self):
+        rnd = random.Random(2022)
+        for _ in range(300):
+            self.assertSameAsPatterns(random_markdown(rnd, 300))
+
+
+class ShareDataTest(unittest.TestCase):
+    def test_payload(self):
+        data = share.ShareData(image='http://a.jpg', url='http://b', wechat_title=u'a [b](http://c)',
+                               wechat_content=u'c', wechat_line=u'd', weibo=u'e')
+        self.assertEqual(data.share_data, {
+            'image': 'http://a.jpg',
+            'url': 'http://b',
+            'wechat': {'title': u'a', 'content': u'c'},
+            'wechatline': {'title': u'd', 'content': u'd'},
+            'qq': {'title': u'a', 'content': u'c'},
+            'weibo': {'title': u'e', 'content': u'e http://t.cn/share'},
+        })
+        self.assertEqual(data.share_data_for_88, dict(
+            data.share_data,
+            wechat_screenshot=Config.wechat_screenshot,
+            wechatline_screenshot=Config.wechatline_screenshot,
+        ))
+
+    def test_changing_a_payload_changes_no_other(self):
+        data = share.ShareData(url='http://b', wechat_title=u'a', weibo=u'e')
+        payload = data.share_data
+        payload['wechat']['title'] = u'changed'
+        payload['url'] = u'changed'
+        payload_for_88 = data.share_data_for_88
+        payload_for_88['wechat_screenshot']['title'] = u'changed'
+
+        self.assertEqual(data.share_data['wechat']['title'], u'a')
+        self.assertEqual(data.share_data['url'], 'http://b')
+        self.assertEqual(payload_for_88['wechat']['title'], u'a')
+        self.assertNotEqual(Config.wechat_screenshot.get('title'), u'changed')
+        self.assertNotEqual(data.share_data_for_88['wechat_screenshot'].get('title'), u'changed')
+
+    def test_changing_a_field_rebuilds(self):
+        data = share.ShareData(url='http://b')
+        self.assertEqual(data.share_data['url'], 'http://b')
+        data.url = 'http://c'
+        self.assertEqual(data.share_data['url'], 'http://c')
+        self.assertEqual(data.share_data_for_88['url'], 'http://c')
+
+
+class GetSharePayloadsTest(unittest.TestCase):
+    items = [
+        {'url': 'http://a', 'wechat_title': u'a', 'weibo': u'b'},
+        {'url': 'http://c', 'wechat_title': u'c', 'weibo': (u'd', u' e')},
+    ]
+
+    def setUp(self):
+        flush_redis()
+
+    def tearDown(self):
+        share.db = db
+
+    def expected(self, for_88=False):
+        return [share.ShareData(**item).share_data_for_88 if for_88 else share.ShareData(**item).share_data
+                for item in self.items]
+
+    def test_payloads_are_cached(self):
+        self.assertEqual(share.get_share_payloads(self.items), self.expected())
+        self.assertEqual(len(db.keys('c:share:std:*')), 2)
+        self.assertEqual(share.get_share_payloads(self.items), self.expected())
+        self.assertEqual(share.get_share_payloads(self.items, for_88=True), self.expected(for_88=True))
+
+    def test_single_item(self):
+        item = self.items[1]
+        self.assertEqual(share.get_share_payload(**item), self.expected()[1])
+        self.assertEqual(share.get_share_payload(for_88=True, **item), self.expected(for_88=True)[1])
+        self.assertEqual(share.get_share_payloads([item]), [share.get_share_payload(**item)])
+
+    def test_redis_down(self):
+        share.db = DownRedis()
+        self.assertEqual(share.get_share_payloads(self.items), self.expected())
+        self.assertEqual(share.get_share_payloads(self.items, for_88=True), self.expected(for_88=True))
+
+    def test_lazy_translations(self):
+        items = [{'url': ugettext_lazy(u'http://a'), 'image': ugettext_lazy(u'http://a.jpg'), 'weibo': (u'b', u' c')}]
+        text = [{'url': u'http://a', 'image': u'http://a.jpg', 'weibo': (u'b', u' c')}]
+
+        payloads = share.get_share_payloads(items)
+        self.assertEqual(payloads, share.get_share_payloads(text))
+        self.assertEqual(share.get_share_payloads(items), payloads)
+        self.assertEqual(len(db.keys('c:share:std:*')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
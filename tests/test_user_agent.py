@@ -0,0 +1,89 @@
+# coding=utf-8
+import os
+import random
+import re
+import unittest
+
+import tests  # noqa, configures django
+
+from gm_share.commons.enums import PLATFORM_TYPE
+from gm_share.commons.user_agent import _classified, _classify, classify_user_agent
+
+
+def load_user_agents():
+    """[(user_agent, (platform, from_client, app_version))] of tests/data/user_agents.tsv."""
+    path = os.path.join(os.path.dirname(__file__), 'data', 'user_agents.tsv')
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            platform, from_client, app_version, user_agent = line.split('\t')
+            expected = (PLATFORM_TYPE[platform.upper()], from_client == '1',
+                        None if app_version == '-' else app_version)
+            samples.append((user_agent, expected))
+    return samples
+
+
+def get_client_and_platform(user_agent):
+    """what CommonView.stage_pre did before classify_user_agent."""
+    from_client = False
+    if re.search(r'Gengmei', user_agent, re.IGNORECASE):
+        from_client = True
+    if re.search(r'gmdoctor', user_agent, re.IGNORECASE):
+        from_client = True
+
+    if (
+            re.search(r'iPhone', user_agent, re.IGNORECASE) or
+            re.search(r'iPad', user_agent, re.IGNORECASE)
+    ):
+        platform = PLATFORM_TYPE.IOS
+    elif re.search(r'Android', user_agent, re.IGNORECASE):
+        platform = PLATFORM_TYPE.ANDROID
+    else:
+        platform = PLATFORM_TYPE.PC
+    return platform, from_client
+
+
+def random_user_agents(n, seed=17):
+    # fragments of every token, so tokens overlap and touch the way they can in the wild
+    chars = 'gengmeiGENGMEIphonadroiPADmdct /v.0123456789'
+    rnd = random.Random(seed)
+    return [''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 40))) for _ in range(n)]
+
+
+class ClassifyUserAgentTest(unittest.TestCase):
+    def setUp(self):
+        _classified.clear()
+
+    def test_recorded_samples(self):
+        for user_agent, expected in load_user_agents():
+            self.assertEqual(classify_user_agent(user_agent), expected, user_agent)
+
+    def test_same_as_old_logic(self):
+        user_agents = [ua for ua, _ in load_user_agents()] + random_user_agents(20000)
+        for user_agent in user_agents:
+            self.assertEqual(_classify(user_agent)[:2], get_client_and_platform(user_agent), user_agent)
+
+    def test_empty_user_agent(self):
+        self.assertEqual(classify_user_agent(None), (PLATFORM_TYPE.UNKNOWN, False, None))
+        self.assertEqual(classify_user_agent(''), (PLATFORM_TYPE.UNKNOWN, False, None))
+
+    def test_app_version(self):
+        self.assertEqual(classify_user_agent('Gengmei/7.2.0 (iPhone; iOS 11.3; Scale/2.00)')[2], '7.2.0')
+        self.assertEqual(classify_user_agent('okhttp/3.8.0 GENGMEI v6.8 android')[2], '6.8')
+        self.assertEqual(classify_user_agent('Mozilla/5.0 (iPad) gmdoctor/2.3')[2], '2.3')
+        # a version next to another product is not ours
+        self.assertIsNone(classify_user_agent('Mozilla/5.0 (iPhone) MicroMessenger/6.5.7 Gengmei')[2])
+
+    def test_cached_per_user_agent(self):
+        user_agent = load_user_agents()[0][0]
+        first = classify_user_agent(user_agent)
+
+        self.assertIs(classify_user_agent(user_agent), first)
+        self.assertEqual(_classified.stats()['size'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
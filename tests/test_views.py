@@ -0,0 +1,453 @@
+# coding=utf-8
+import json
+import threading
+import time
+import unittest
+
+from django.conf import settings
+from django.contrib.sessions.backends.cache import SessionStore
+from django.middleware.csrf import CsrfViewMiddleware
+from django.test import RequestFactory
+from helios.rpc.exceptions import RPCFaultException
+
+from tests import flush_redis
+from tests.stubs import DownRedis, StubInvoker
+
+from gm_share.commons.enums import RPC_ERROR_CODE
+from gm_share.libs import session_user
+from gm_share.libs.pool import get_pool
+from gm_share.libs.redis_db import db
+from gm_share.libs.rpc import BatchingInvoker
+from gm_share.weixin import async_wx
+from gm_share.weixin.views import base, wx_auth
+from gm_share.weixin.views.base import CacheMixinForHtml, Context, FastHttpResponse, JsonView, TemplateView
+from gm_share.weixin.views.fetch import FetchTask, run_fetch_tasks
+
+
+class PageView(TemplateView):
+    url_name = 'page'
+    template = 'page.html'
+    return_weixin_config = True
+
+    def stage_transform(self, ctx):
+        return {'items': [{'title': 'diary'}]}
+
+
+class ViewTestCase(unittest.TestCase):
+    def setUp(self):
+        flush_redis()
+        session_user.session_user_cache.clear()
+        self.factory = RequestFactory()
+        self.invoker = StubInvoker({'api/user_info': lambda: {'user_id': 7}})
+        self._get_base_rpc_invoker = base.get_base_rpc_invoker
+        base.get_base_rpc_invoker = lambda: self.invoker
+
+    def tearDown(self):
+        base.get_base_rpc_invoker = self._get_base_rpc_invoker
+
+    def get(self, view, path='/page', session_key=None, **extra):
+        request = self.factory.get(path, **extra)
+        if session_key:
+            request.COOKIES['sessionid'] = session_key
+        return view(request)
+
+
+def slow(seconds, value):
+    def call(*args, **kwargs):
+        time.sleep(seconds)
+        return value
+    return call
+
+
+def fail(error):
+    def call(*args, **kwargs):
+        raise error
+    return call
+
+
+class DecorateTest(ViewTestCase):
+    signed = {'wechat_sdk': {'signature': 'signed', 'appId': 'wx-test-app'}}
+
+    def setUp(self):
+        super(DecorateTest, self).setUp()
+        self._get_wechat_sdk = async_wx.get_wechat_sdk
+        self._timeouts = base.decorate_user_info_timeout, base.decorate_wechat_sdk_timeout
+        async_wx.get_wechat_sdk = lambda absolute_url, app_id=None: self.signed
+
+    def tearDown(self):
+        async_wx.get_wechat_sdk = self._get_wechat_sdk
+        base.decorate_user_info_timeout, base.decorate_wechat_sdk_timeout = self._timeouts
+        super(DecorateTest, self).tearDown()
+
+    def test_user_info_and_signing(self):
+        response = self.get(PageView(), session_key='session')
+
+        self.assertIn('data-user="7"', response.content)
+        self.assertIn('data-signature="signed"', response.content)
+
+    def test_timeouts_share_one_start(self):
+        base.decorate_user_info_timeout = base.decorate_wechat_sdk_timeout = 0.3
+        self.invoker.delay = 1
+        async_wx.get_wechat_sdk = slow(1, self.signed)
+
+        started = time.time()
+        response = self.get(PageView(), session_key='session')
+
+        self.assertLess(time.time() - started, 0.5)
+        self.assertIn('data-user="None"', response.content)
+        self.assertIn('data-signature=""', response.content)
+
+    def test_busy_async_pool_does_not_hold_up_signing(self):
+        base.decorate_wechat_sdk_timeout = 0.5
+        release = threading.Event()
+        busy = [get_pool('wx', async_wx.async_pool_size).apply_async(release.wait)
+                for _ in range(async_wx.async_pool_size)]
+        try:
+            response = self.get(PageView(), session_key='session')
+        finally:
+            release.set()
+            for b in busy:
+                b.wait()
+
+        self.assertIn('data-signature="signed"', response.content)
+
+
+class CurrentUserTest(ViewTestCase):
+    def setUp(self):
+        super(CurrentUserTest, self).setUp()
+        self.view = PageView()
+        self.view.return_weixin_config = False
+
+    def tearDown(self):
+        session_user.db = db
+        super(CurrentUserTest, self).tearDown()
+
+    def test_user_of_the_session_is_cached(self):
+        self.assertIn('data-user="7"', self.get(self.view, session_key='session').content)
+        session_user.session_user_cache.clear()
+        self.assertIn('data-user="7"', self.get(self.view, session_key='session').content)
+        self.assertEqual(len(self.invoker.calls), 1)
+
+    def test_redis_down(self):
+        session_user.db = DownRedis()
+        self.assertIn('data-user="7"', self.get(self.view, session_key='session').content)
+        self.assertIn('data-user="7"', self.get(self.view, session_key='session').content)
+        self.assertEqual(len(self.invoker.calls), 2)
+
+    def test_rpc_failing(self):
+        self.invoker.handlers['api/user_info'] = fail(RPCFaultException(500, u'backend down'))
+        self.assertIn('data-user="None"', self.get(self.view, session_key='session').content)
+
+
+class FeedView(JsonView):
+    url_name = 'feed'
+    fetch_tasks = {
+        'user': FetchTask('fetch_user'),
+        'diaries': FetchTask('fetch_diaries'),
+        'feed': FetchTask('fetch_feed', deps=('user', 'diaries')),
+    }
+    delay = 0.2
+
+    def fetch_user(self, ctx):
+        time.sleep(self.delay)
+        return ctx.rpc['api/user_info']().unwrap()
+
+    def fetch_diaries(self, ctx):
+        time.sleep(self.delay)
+        return [1, 2]
+
+    def fetch_feed(self, ctx, user, diaries):
+        return {'user_id': user['user_id'], 'diaries': diaries}
+
+    def stage_transform(self, ctx):
+        return ctx.fetch
+
+
+
+
+class FetchTasksTest(ViewTestCase):
+    def test_independent_tasks_run_side_by_side(self):
+        started = time.time()
+        response = self.get(FeedView(), session_key='session')
+        elapsed = time.time() - started
+
+        self.assertEqual(json.loads(response.content), {
+            'user': {'user_id': 7},
+            'diaries': [1, 2],
+            'feed': {'user_id': 7, 'diaries': [1, 2]},
+        })
+        self.assertGreaterEqual(elapsed, FeedView.delay)
+        self.assertLess(elapsed, 2 * FeedView.delay)
+
+    def test_login_required_redirects_to_login(self):
+        view = FeedView()
+        view.fetch_diaries = fail(RPCFaultException(RPC_ERROR_CODE.LOGIN_REQUIRED, u'登录过期'))
+
+        response = self.get(view, path='/feed?page=2', session_key='session')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '/login?next_url=%2Ffeed%3Fpage%3D2')
+
+        response = self.get(view, session_key='session', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(json.loads(response.content)['error'], 1001)
+
+    def test_first_error_is_raised(self):
+        tasks = {
+            'slow': FetchTask(slow(0.5, 1)),
+            'broken': FetchTask(fail(KeyError('diary'))),
+            'after': FetchTask(slow(0, 2), deps=('broken',)),
+        }
+        started = time.time()
+        with self.assertRaises(KeyError):
+            run_fetch_tasks(FeedView(), Context(), tasks)
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_dependency_cycle(self):
+        tasks = {
+            'a': FetchTask(slow(0, 1), deps=('b',)),
+            'b': FetchTask(slow(0, 2), deps=('a',)),
+            'c': FetchTask(slow(0, 3)),
+        }
+        with self.assertRaisesRegexp(ValueError, 'dependency cycle: a, b'):
+            run_fetch_tasks(FeedView(), Context(), tasks)
+
+        with self.assertRaisesRegexp(ValueError, 'dependency cycle: a'):
+            run_fetch_tasks(FeedView(), Context(), {'a': FetchTask(slow(0, 1), deps=('a',))})
+
+    def test_unknown_dependency(self):
+        with self.assertRaisesRegexp(ValueError, 'a depends on unknown task b'):
+            run_fetch_tasks(FeedView(), Context(), {'a': FetchTask(slow(0, 1), deps=('b',))})
+
+
+class BatchView(JsonView):
+    url_name = 'batch'
+    rpc_batching = True
+
+    def stage_fetch(self, ctx):
+        first = ctx.rpc['api/diary/get'](diary_id=1)
+        again = ctx.rpc['api/diary/get'](diary_id=1)
+        other = ctx.rpc['api/diary/get'](diary_id=2)
+        diaries = [first.unwrap(), again.unwrap(), other.unwrap()]
+        # queued after the others went out and never used, still sent with its stage
+        ctx.rpc['api/diary/seen'](diary_id=1)
+        return {'diaries': diaries}
+
+    def stage_transform(self, ctx):
+        return dict(ctx.fetch, sent=len(base.get_base_rpc_invoker().calls))
+
+
+class RPCBatchingTest(ViewTestCase):
+    def setUp(self):
+        super(RPCBatchingTest, self).setUp()
+        self.invoker.handlers.update({
+            'api/diary/get': lambda diary_id: {'id': diary_id},
+            'api/diary/seen': lambda diary_id: None,
+        })
+
+    def test_same_calls_share_one_round_trip(self):
+        response = self.get(BatchView(), session_key='session')
+
+        self.assertEqual(json.loads(response.content), {
+            'diaries': [{'id': 1}, {'id': 1}, {'id': 2}],
+            'sent': 3,
+        })
+        self.assertEqual(sorted(self.invoker.calls), [
+            ('api/diary/get', {'diary_id': 1}),
+            ('api/diary/get', {'diary_id': 2}),
+            ('api/diary/seen', {'diary_id': 1}),
+        ])
+
+    def test_queued_calls_run_side_by_side(self):
+        self.invoker.delay = 0.2
+        started = time.time()
+        self.get(BatchView(), session_key='session')
+        # two round trips, the diaries together and then the unused call; one by one takes four
+        self.assertLess(time.time() - started, 0.6)
+
+    def test_fault_is_raised_to_every_caller(self):
+        self.invoker.handlers['api/diary/get'] = fail(RPCFaultException(404, u'diary not found'))
+        rpc = BatchingInvoker(self.invoker)
+        results = [rpc['api/diary/get'](diary_id=1), rpc['api/diary/get'](diary_id=1)]
+
+        for result in results:
+            with self.assertRaises(RPCFaultException) as raised:
+                result.unwrap()
+            self.assertEqual(raised.exception.error, 404)
+        self.assertEqual(len(self.invoker.calls), 1)
+
+    def test_login_required_redirects_to_login(self):
+        self.invoker.handlers['api/diary/get'] = fail(
+            RPCFaultException(RPC_ERROR_CODE.LOGIN_REQUIRED, u'登录过期'))
+        response = self.get(BatchView(), session_key='session')
+        self.assertEqual(response.status_code, 302)
+
+
+class CachedPageView(CacheMixinForHtml, PageView):
+    page_cache_seconds = 60
+    return_weixin_config = False
+    # called once while the page cache key is built, to interleave another request
+    interleave = None
+    fetch_error = None
+
+    def get_page_cache_suffix(self, ctx):
+        interleave, self.interleave = self.interleave, None
+        if interleave is not None:
+            interleave()
+        return super(CachedPageView, self).get_page_cache_suffix(ctx)
+
+    def stage_fetch(self, ctx):
+        if self.fetch_error is not None:
+            raise self.fetch_error
+        return super(CachedPageView, self).stage_fetch(ctx)
+
+
+class OldStyleCachedPageView(CachedPageView):
+    """caches its page the way subclasses written for older releases do."""
+    page_cache_seconds = None
+
+    def stage_init(self, ctx):
+        # did nothing before pages were served from the cache
+        self.return_from_cache_direclty()
+        self.return_from_cache_direclty('page')
+        self.return_from_cache_direclty('page', ctx=ctx)
+        return super(OldStyleCachedPageView, self).stage_init(ctx)
+
+    def stage_post(self, ctx):
+        super(OldStyleCachedPageView, self).stage_post(ctx)
+        self.cache_render_page(ctx, 60, 'page')
+
+
+class FormPageView(CachedPageView):
+    template = 'form.html'
+
+
+class SessionPageView(CachedPageView):
+    def stage_transform(self, ctx):
+        obj = super(SessionPageView, self).stage_transform(ctx)
+        obj['items'].append({'title': ctx.request.session.get('title')})
+        return obj
+
+
+class PageCacheTest(ViewTestCase):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        session_user.set_user_id('session-a', 1)
+        session_user.set_user_id('session-b', 2)
+
+    def page_locks(self):
+        return db.keys('c:page:ps:*:lock')
+
+    def test_page_is_cached_per_session(self):
+        view = CachedPageView()
+        first = self.get(view, session_key='session-a')
+        again = self.get(view, session_key='session-a')
+        other = self.get(view, session_key='session-b')
+
+        self.assertEqual(again['X-Page-Cache'], 'hit')
+        self.assertEqual(again.content, first.content)
+        self.assertFalse(other.has_header('X-Page-Cache'))
+        self.assertIn('data-user="2"', other.content)
+
+    def test_interleaved_request_does_not_leak_its_page(self):
+        # view instances are shared by all requests of a worker, another
+        # request may start while this one looks up the cache
+        view = CachedPageView()
+        view.interleave = lambda: self.get(view, session_key='session-a')
+
+        response = self.get(view, session_key='session-b')
+
+        self.assertIn('data-user="2"', response.content)
+        self.assertFalse(response.has_header('X-Page-Cache'))
+
+    def test_lock_is_released_when_the_page_is_not_rendered(self):
+        view = CachedPageView()
+        view.fetch_error = ValueError('backend down')
+        with self.assertRaises(ValueError):
+            self.get(view, session_key='session-a')
+        self.assertEqual(self.page_locks(), [])
+
+        view.fetch_error = FastHttpResponse(base.HttpResponseRedirect('/elsewhere'))
+        self.assertEqual(self.get(view, session_key='session-a').status_code, 302)
+        self.assertEqual(self.page_locks(), [])
+
+        view.fetch_error = None
+        started = time.time()
+        self.assertEqual(self.get(view, session_key='session-a').status_code, 200)
+        self.assertLess(time.time() - started, base.page_cache_wait_timeout)
+
+    def test_page_with_csrf_token_is_not_cached(self):
+        # CsrfViewMiddleware sets the cookie after the view, the token must not reach other visitors
+        view = FormPageView()
+        middleware = CsrfViewMiddleware()
+        tokens = []
+        for _ in range(2):
+            request = self.factory.get('/page')
+            middleware.process_view(request, view, (), {})
+            response = middleware.process_response(request, view(request))
+
+            self.assertFalse(response.has_header('X-Page-Cache'))
+            token = response.cookies[settings.CSRF_COOKIE_NAME].value
+            self.assertIn("value='%s'" % token, response.content)
+            tokens.append(token)
+        self.assertNotEqual(tokens[0], tokens[1])
+        self.assertEqual(db.keys('c:page:ps:*'), [])
+
+    def test_page_from_the_session_is_not_cached(self):
+        view = SessionPageView()
+        for title in ('first', 'second'):
+            request = self.factory.get('/page')
+            request.session = SessionStore()
+            request.session['title'] = title
+            response = view(request)
+
+            self.assertIn('<p>%s</p>' % title, response.content)
+            self.assertFalse(response.has_header('X-Page-Cache'))
+        self.assertEqual(db.keys('c:page:ps:*'), [])
+
+    def test_old_signatures(self):
+        view = OldStyleCachedPageView()
+        first = self.get(view, session_key='session-a')
+        again = self.get(view, session_key='session-a')
+
+        self.assertFalse(first.has_header('X-Page-Cache'))
+        self.assertEqual(again['X-Page-Cache'], 'hit')
+        self.assertEqual(again.content, first.content)
+
+
+class StubSnsWeixin(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get_sns_userinfo(self, access_token, openid):
+        self.calls += 1
+        return {'nickname': 'gm', 'headimgurl': 'http://pic.gmei.com/a.jpg', 'openid': openid}
+
+
+class WeixinUserInfoTest(unittest.TestCase):
+    expected = {'nickname': 'gm', 'headimgurl': 'http://pic.gmei.com/a.jpg', 'openid': 'openid'}
+
+    def setUp(self):
+        flush_redis()
+        self.weixin = StubSnsWeixin()
+        self._get_wx_api = wx_auth.get_wx_api
+        wx_auth.get_wx_api = lambda app_id=None: self.weixin
+
+    def tearDown(self):
+        wx_auth.get_wx_api = self._get_wx_api
+        wx_auth.db = db
+
+    def test_user_info_is_cached(self):
+        view = wx_auth.WeixinAuthBaseView()
+        self.assertEqual(view.get_weixin_user_info('openid', 'token'), self.expected)
+        self.assertEqual(view.get_weixin_user_info('openid', 'token'), self.expected)
+        self.assertEqual(self.weixin.calls, 1)
+
+    def test_redis_down(self):
+        wx_auth.db = DownRedis()
+        view = wx_auth.WeixinAuthBaseView()
+        self.assertEqual(view.get_weixin_user_info('openid', 'token'), self.expected)
+        self.assertEqual(view.get_weixin_user_info('openid', 'token'), self.expected)
+        self.assertEqual(self.weixin.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
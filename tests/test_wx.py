@@ -0,0 +1,232 @@
+# coding=utf-8
+import json
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from tests import flush_redis
+
+from gm_share.libs.circuit_breaker import CircuitBreaker
+from gm_share.libs.redis_db import db
+from gm_share.weixin import wx
+
+
+class StubResponse(object):
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class StubWeixin(object):
+    """api.weixin.qq.com token and ticket endpoints, answering slowly like the real one."""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.calls.append(url)
+            n = len(self.calls)
+        time.sleep(self.delay)
+        if url.endswith('/cgi-bin/ticket/getticket'):
+            return StubResponse({'ticket': 'ticket-%d' % n, 'expires_in': 7200})
+        return StubResponse({'access_token': 'token-%d' % n, 'expires_in': 7200})
+
+    def count(self, path):
+        return len([url for url in self.calls if url.endswith(path)])
+
+
+class WxTestCase(unittest.TestCase):
+    def setUp(self):
+        flush_redis()
+        wx.credential_cache.clear()
+        wx.credential_expiry.clear()
+        wx.jsapi_sign_cache.clear()
+        self.weixin = StubWeixin()
+        self._get_session = wx.get_session
+        wx.get_session = lambda: self.weixin
+
+    def tearDown(self):
+        wx.get_session = self._get_session
+
+    def expire_credentials(self):
+        db.delete('wx:access_token', 'wx:jsapi_ticket')
+        wx.credential_cache.clear()
+
+
+class SingleFlightRefreshTest(WxTestCase):
+    threads = 50
+
+    def fetch_from_threads(self):
+        results = []
+        errors = []
+
+        def work():
+            try:
+                results.append(wx.get_wechat_sdk('http://m.igengmei.com/diary/1')['wechat_sdk'])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(self.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_one_fetch_per_expiry(self):
+        for expiry in range(1, 3):
+            results = self.fetch_from_threads()
+
+            self.assertEqual(self.weixin.count('/cgi-bin/token'), expiry)
+            self.assertEqual(self.weixin.count('/cgi-bin/ticket/getticket'), expiry)
+            self.assertEqual(len(results), self.threads)
+            self.assertTrue(all(r['signature'] for r in results))
+            self.expire_credentials()
+
+    def test_waiters_get_the_published_token(self):
+        tokens = []
+
+        def work():
+            tokens.append(wx.get_wx_api().get_access_token())
+
+        threads = [threading.Thread(target=work) for _ in range(self.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(set(tokens), {db.get('wx:access_token')})
+        self.assertIsNone(db.get('wx:access_token:lock'))
+
+
+def save_like_old_release(key, value, expires_in):
+    """how releases before 0.1.4 stored a credential: no ttl, expiry in a second key."""
+    expired_time = datetime.utcnow() + timedelta(seconds=expires_in)
+    db.set(key, value)
+    db.set(key + ':expired_time', expired_time.strftime(wx.legacy_datetime_format))
+
+
+def read_like_old_release(key):
+    """the credential a release before 0.1.4 would use, None where it would refresh."""
+    value = db.get(key)
+    if value is None:
+        return None
+    expired_time = datetime.strptime(db.get(key + ':expired_time'), wx.legacy_datetime_format)
+    return value if datetime.utcnow() < expired_time else None
+
+
+class MixedReleaseTest(WxTestCase):
+    def test_credential_of_old_release_is_used(self):
+        save_like_old_release('wx:access_token', 'old-token', 3600)
+
+        self.assertEqual(wx.get_wx_api().get_access_token(), 'old-token')
+        self.assertEqual(self.weixin.calls, [])
+
+    def test_expired_credential_of_old_release_is_refreshed(self):
+        save_like_old_release('wx:access_token', 'old-token', -1)
+
+        self.assertEqual(wx.get_wx_api().get_access_token(), 'token-1')
+
+    def test_old_release_reads_saved_credential(self):
+        token = wx.get_wx_api().get_access_token()
+
+        self.assertEqual(read_like_old_release('wx:access_token'), token)
+        # the value never outlives its expiry key
+        self.assertGreater(db.pttl('wx:access_token:expired_time'), db.pttl('wx:access_token'))
+
+    def test_refresher_renews_credential_of_old_release(self):
+        api = wx.get_wx_api()
+        save_like_old_release(api.access_token_key, 'old-token', 100)
+        save_like_old_release(api.jsapi_ticket_key, 'old-ticket', 5000)
+
+        api.refresh_credentials(min_ttl=1000)
+
+        self.assertEqual(self.weixin.count('/cgi-bin/token'), 1)
+        self.assertEqual(self.weixin.count('/cgi-bin/ticket/getticket'), 0)
+        self.assertGreater(wx.credential_expires_in(api.jsapi_ticket_key), 1000)
+
+
+class JsapiSignCacheTest(WxTestCase):
+    url = 'http://m.igengmei.com/diary/1'
+
+    def sign_expires_in(self, api):
+        _, jsapi_ticket = api.get_jsapi_credentials()
+        sign = api.get_cached_jsapi_sign(jsapi_ticket, self.url)
+        self.assertEqual(api.get_cached_jsapi_sign(jsapi_ticket, self.url), sign)
+        return wx.jsapi_sign_cache.expired_at((jsapi_ticket, self.url)) - time.time()
+
+    def test_sign_lives_as_long_as_the_ticket(self):
+        db.setex('wx:access_token', 6000, 'token')
+        db.setex('wx:jsapi_ticket', 5000, 'ticket')
+
+        self.assertAlmostEqual(self.sign_expires_in(wx.get_wx_api()), 5000, delta=5)
+
+    def test_sign_of_refreshed_ticket(self):
+        self.assertAlmostEqual(self.sign_expires_in(wx.get_wx_api()), 7200 - 60, delta=5)
+
+    def test_sign_of_unknown_ticket(self):
+        sign = wx.get_wx_api().get_cached_jsapi_sign('ticket', self.url)
+
+        self.assertTrue(sign['signature'])
+        expires_in = wx.jsapi_sign_cache.expired_at(('ticket', self.url)) - time.time()
+        self.assertAlmostEqual(expires_in, wx.local_cache_ttl, delta=5)
+
+
+class CircuitBreakerTest(WxTestCase):
+    def setUp(self):
+        super(CircuitBreakerTest, self).setUp()
+        self._breaker = wx.wx_breaker
+        wx.wx_breaker = CircuitBreaker('weixin', failure_rate=0.5, min_calls=2, window=30, cooldown=0.05)
+
+    def tearDown(self):
+        wx.wx_breaker = self._breaker
+        super(CircuitBreakerTest, self).tearDown()
+
+    def open_circuit(self):
+        wx.wx_breaker.record_failure()
+        wx.wx_breaker.record_failure()
+        self.assertEqual(wx.wx_breaker.stats()['state'], CircuitBreaker.OPEN)
+
+    def test_circuit_open_is_not_reported_as_unknown(self):
+        self.open_circuit()
+
+        for call in (lambda api: api.get_access_token(), lambda api: api.get_user_info('token', 'openid')):
+            with self.assertRaises(wx.WxTkApiErr) as raised:
+                call(wx.get_wx_api())
+            self.assertEqual(raised.exception.desc, 'circuit open')
+        self.assertEqual(self.weixin.calls, [])
+
+    def test_probe_failing_with_any_error_reopens_the_circuit(self):
+        self.open_circuit()
+        time.sleep(0.06)
+
+        def broken(method, url, **kwargs):
+            raise ValueError('bad params')
+        self.weixin.request = broken
+        with self.assertRaises(wx.WxTkApiErr):
+            wx.get_wx_api().get_access_token()
+        self.assertEqual(wx.wx_breaker.stats()['state'], CircuitBreaker.OPEN)
+
+        # the next probe still goes out and closes the circuit again
+        del self.weixin.request
+        time.sleep(0.06)
+        self.assertEqual(wx.get_wx_api().get_access_token(), 'token-1')
+        self.assertEqual(wx.wx_breaker.stats()['state'], CircuitBreaker.CLOSED)
+
+
+class HttpPoolTest(unittest.TestCase):
+    def test_a_connection_for_every_weixin_thread(self):
+        adapter = wx.get_session().get_adapter('https://api.weixin.qq.com')
+        self.assertGreaterEqual(adapter._pool_maxsize, wx.async_pool_size + wx.sign_pool_size)
+
+
+if __name__ == '__main__':
+    unittest.main()